@@ -0,0 +1,149 @@
+""" Approximate nearest-neighbour search over tf-idf vectors.
+
+    Benchmark against the exact ranking, e.g. on the Town02 folders:
+
+    python -m BOW.imagesearch.ann --db ImaAdd.db --vocabulary vocabulary.pkl --queries W000_P100_V075_P300
+"""
+import sys
+import time
+import json
+import pickle
+import argparse
+import numpy as np
+from scipy import sparse
+from BOW.imagesearch.kmeans import minibatch_kmeans
+
+
+def tfidf_vectors(histograms, idf):
+    """ L2-normalized tf-idf rows of a sparse (images x words) matrix. """
+    v = sparse.csr_matrix(histograms.multiply(idf[None, :]))
+    norms = np.sqrt(np.asarray(v.multiply(v).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(v.multiply(1.0 / norms[:, None]))
+
+
+class IVFIndex(object):
+
+    def __init__(self, searcher, nlist=64, nprobe=4, rerank=True, seed=None, train_size=8192):
+        """ Inverted-file index on top of a SparseSearcher. Images are
+            clustered into nlist cells on their normalized tf-idf
+            vectors; a query only visits the nprobe cells whose centers
+            are most similar to it. With rerank the visited images are
+            scored with the exact searcher distance, otherwise by cosine
+            distance. nprobe trades recall against latency. The cell
+            centers are trained on at most train_size sampled images,
+            only that sample is made dense. """
+
+        self.searcher = searcher
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.seed = seed
+        self.train_size = train_size
+        self.build()
+
+    def build(self):
+        src = self.searcher
+        self.vectors = tfidf_vectors(src.histograms, src.idf)
+        n = self.vectors.shape[0]
+        nlist = min(self.nlist, n)
+        if nlist == 0:
+            self.centers = np.zeros((0, self.vectors.shape[1]))
+            self.cell_of = np.zeros(0, dtype=np.int64)
+        else:
+            # 只对抽样的行训练聚类中心，全部图像的分配在稀疏矩阵上完成
+            rows = np.arange(n)
+            train_size = max(self.train_size, nlist)
+            if n > train_size:
+                rows = np.sort(np.random.default_rng(self.seed).choice(n, train_size, replace=False))
+            sample = self.vectors[rows].toarray().astype(np.float32)
+            self.centers = minibatch_kmeans(sample, nlist, batch_size=min(len(rows), 1024), seed=self.seed)[0]
+            self.centers /= np.maximum(np.linalg.norm(self.centers, axis=1), 1e-12)[:, None]
+            self.cell_of = np.asarray(self.vectors.dot(self.centers.T)).argmax(axis=1)
+
+        # cells as csr-style lists: rows of cell c are order[offsets[c]:offsets[c+1]]
+        self.order = np.argsort(self.cell_of, kind='stable')
+        self.offsets = np.searchsorted(self.cell_of[self.order], np.arange(len(self.centers) + 1))
+
+    def candidates(self, h, nprobe=None):
+        """ Rows of the images in the nprobe cells closest to h. """
+        nprobe = self.nprobe if nprobe is None else nprobe
+        q = tfidf_vectors(sparse.csr_matrix(np.asarray(h, dtype=np.float64)), self.searcher.idf)
+        sims = np.asarray(q.dot(self.centers.T)).ravel()
+        cells = np.argsort(-sims)[:nprobe]
+        return np.sort(np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in cells]
+                                      + [np.zeros(0, dtype=np.int64)]))
+
+    def query_histogram(self, h, k=5, nprobe=None):
+        """ Approximate top-k (distance, imid) for a histogram. """
+        rows = self.candidates(h, nprobe)
+        if self.rerank:
+            dist = self.searcher.score(h, rows)
+        else:
+            q = tfidf_vectors(sparse.csr_matrix(np.asarray(h, dtype=np.float64)), self.searcher.idf)
+            dist = 1 - np.asarray(self.vectors[rows].dot(q.T).todense()).ravel()
+        imids = self.searcher.imids[rows]
+        order = np.lexsort((imids, dist))[:k]
+        return list(zip(dist[order].tolist(), imids[order].tolist()))
+
+    def query(self, imname, k=5, nprobe=None):
+        return self.query_histogram(self.searcher.get_imhistogram(imname), k, nprobe)
+
+
+def benchmark(searcher, names, k=5, nlist=64, nprobes=(1, 2, 4, 8, 16), seed=0):
+    """ Recall@k against the exact searcher.query() ranking and query
+        latency (ms) of the exact scan and of the IVF index per nprobe. """
+
+    def latency(times):
+        times = 1000.0 * np.array(times)
+        return {'mean_ms': float(times.mean()), 'p50_ms': float(np.percentile(times, 50)),
+                'p99_ms': float(np.percentile(times, 99))}
+
+    hists = [searcher.get_imhistogram(name) for name in names]
+    exact, times = [], []
+    for h in hists:
+        t0 = time.perf_counter()
+        exact.append(set(imid for d, imid in searcher.query_histogram(h)[:k]))
+        times.append(time.perf_counter() - t0)
+    report = {'images': len(searcher.filenames), 'queries': len(names), 'k': k, 'exact': latency(times)}
+
+    t0 = time.perf_counter()
+    index = IVFIndex(searcher, nlist=nlist, seed=seed)
+    report['ivf_build_s'] = time.perf_counter() - t0
+    report['ivf'] = []
+    for nprobe in nprobes:
+        recall, times = [], []
+        for h, truth in zip(hists, exact):
+            t0 = time.perf_counter()
+            res = index.query_histogram(h, k, nprobe)
+            times.append(time.perf_counter() - t0)
+            recall.append(len(truth & set(imid for d, imid in res)) / float(max(len(truth), 1)))
+        entry = {'nlist': index.centers.shape[0], 'nprobe': nprobe, 'recall_at_k': float(np.mean(recall))}
+        entry.update(latency(times))
+        report['ivf'].append(entry)
+    return report
+
+
+def main(argv=None):
+    from BOW.imagesearch.imagesearch import SparseSearcher
+
+    parser = argparse.ArgumentParser(description='IVF vs exact retrieval benchmark')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--vocabulary', required=True)
+    parser.add_argument('--queries', nargs='*', default=[], help='only query images whose path contains one of these, e.g. W000_P100_V075_P300')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--nlist', type=int, default=64)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--max-queries', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    with open(args.vocabulary, 'rb') as f:
+        voc = pickle.load(f)
+    src = SparseSearcher(args.db, voc)
+    names = [name for name in src.filenames
+             if not args.queries or any(part in name for part in args.queries)][:args.max_queries]
+    print(json.dumps(benchmark(src, names, args.k, args.nlist, args.nprobe), indent=2))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+""" Scaling benchmark of the retrieval hot paths: vocabulary training,
+    indexing throughput, query latency (p50/p99) and memory, for growing
+    vocabulary and database sizes. Results are written as JSON so runs
+    can be compared for regressions, e.g.
+
+    python -m BOW.imagesearch.benchmark --synthetic 2000 --vocab 100 1000 --db-sizes 500 2000 --out bench.json
+    python -m BOW.imagesearch.benchmark --folders Town02/W000_P100_V000_P000/RGB --vocab 100 --out bench.json
+
+    --quantizers only times the descriptor -> word assignment: scipy's vq
+    on the float path against the two Hamming paths of hamming.nearest.
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+from scipy.cluster.vq import vq
+from BOW.imagesearch import hamming
+from BOW.imagesearch.vocabulary import Vocabulary, extract_features
+from BOW.imagesearch.imagesearch import Indexer, Searcher, SparseSearcher
+
+
+def synthetic_descriptors(nbr_images, nbr_features=500, nbr_clusters=1024, clusters_per_image=128,
+                          flip_prob=0.1, seed=0):
+    """ ORB-like uint8 descriptors (32 bytes): every image draws from its
+        own clusters_per_image of nbr_clusters random binary centers, with
+        bits flipped at flip_prob, so a vocabulary has real structure to
+        find and words do not occur in every image. """
+    rng = np.random.default_rng(seed)
+    centers = rng.integers(0, 256, (nbr_clusters, 32), dtype=np.uint8)
+    des_list = []
+    for _ in range(nbr_images):
+        own = rng.choice(nbr_clusters, clusters_per_image, replace=False)
+        labels = own[rng.integers(0, clusters_per_image, nbr_features)]
+        flips = np.packbits(rng.random((nbr_features, 256)) < flip_prob, axis=1)
+        des_list.append(centers[labels] ^ flips)
+    names = ['synthetic/%06d.png' % i for i in range(nbr_images)]
+    return names, des_list
+
+
+def recorded_descriptors(folders, max_images=None, feature='orb', workers=None):
+    """ Descriptors of the images in a few recorded folders. """
+    names = []
+    for folder in folders:
+        names += [os.path.join(folder, name) for name in sorted(os.listdir(folder))]
+    names = names[:max_images]
+    des_list = extract_features(names, feature, workers=workers)
+    keep = [i for i, des in enumerate(des_list) if des is not None]
+    return [names[i] for i in keep], [des_list[i] for i in keep]
+
+
+def latency(times):
+    times = 1000.0 * np.array(times)
+    return {'mean_ms': float(times.mean()), 'p50_ms': float(np.percentile(times, 50)),
+            'p99_ms': float(np.percentile(times, 99))}
+
+
+def measure(fn, memory=True):
+    """ (result, seconds, peak MB of traced allocations or None) of fn(). """
+    if memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        res = fn()
+        elapsed = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1] / 2.0**20 if memory else None
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return res, elapsed, peak
+
+
+def bench_queries(query, names, nbr_queries, rng):
+    picks = rng.choice(len(names), nbr_queries, replace=nbr_queries > len(names))
+    times = []
+    for i in picks:
+        t0 = time.perf_counter()
+        query(names[i])
+        times.append(time.perf_counter() - t0)
+    return latency(times)
+
+
+def bench_quantizers(descriptors, vocab_sizes=(100, 1000), memory=True, seed=0):
+    """ Seconds and peak MB of assigning descriptors (n x 32 uint8) to k
+        words sampled from them, for every k: vq as Vocabulary does on
+        the float path, and hamming.nearest_unpacked / nearest_popcount
+        (the latter only with numpy >= 2.0). """
+    rng = np.random.default_rng(seed)
+    report = []
+    for k in vocab_sizes:
+        centers = descriptors[rng.choice(len(descriptors), k, replace=False)]
+        methods = [('vq', lambda: vq(descriptors, centers.astype(np.float64))),
+                   ('hamming_unpacked', lambda: hamming.nearest_unpacked(descriptors, centers))]
+        if hasattr(np, 'bitwise_count'):
+            methods.append(('hamming_popcount', lambda: hamming.nearest_popcount(descriptors, centers)))
+        entry = {'vocab_size': k, 'descriptors': len(descriptors)}
+        for name, fn in methods:
+            _, seconds, peak = measure(fn, memory)
+            entry[name] = {'seconds': seconds, 'peak_mb': peak}
+        report.append(entry)
+    return report
+
+
+def run(names, des_list, vocab_sizes=(100, 1000), db_sizes=(500, 2000), nbr_queries=100, trainer='minibatch',
+        subsampling=10, memory=True, seed=0, workdir=None, verbose=True):
+    """ Train one vocabulary per size on the first max(db_sizes) images,
+        then index and query every database size with it. """
+    rng = np.random.default_rng(seed)
+    db_sizes = [n for n in db_sizes if n <= len(names)] or [len(names)]
+    nbr_train = max(db_sizes)
+    tmp = tempfile.mkdtemp(prefix='bow-bench-', dir=workdir)
+    report = {
+        'config': {'images': len(names), 'descriptors': int(sum(len(d) for d in des_list)),
+                   'vocab_sizes': list(vocab_sizes), 'db_sizes': db_sizes, 'queries': nbr_queries,
+                   'trainer': trainer, 'subsampling': subsampling, 'seed': seed},
+        'platform': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine()},
+        'runs': [],
+    }
+    try:
+        for k in vocab_sizes:
+            voc = Vocabulary('bench%d' % k, 'orb', trainer=trainer)
+            _, train_s, train_mb = measure(lambda: voc.train(names[:nbr_train], k, subsampling,
+                                                             des_list=des_list[:nbr_train], seed=seed), memory)
+            if verbose:
+                print('vocabulary %d words trained in %.2fs' % (voc.nbr_words, train_s))
+            for n in db_sizes:
+                db = os.path.join(tmp, 'bench_%d_%d.db' % (k, n))
+                indx = Indexer(db, voc)
+                indx.create_tables()
+                (nbr, rate), index_s, index_mb = measure(
+                    lambda indx=indx: indx.add_batch(zip(names[:n], des_list[:n]), verbose=False), memory)
+                del indx
+
+                src = Searcher(db, voc)
+                sql_latency = bench_queries(src.query, names[:n], nbr_queries, rng)
+                del src
+                sparse_src, load_s, load_mb = measure(lambda: SparseSearcher(db, voc), memory)
+                sparse_latency = bench_queries(sparse_src.query, names[:n], nbr_queries, rng)
+                del sparse_src
+
+                entry = {
+                    'vocab_size': voc.nbr_words, 'db_size': n,
+                    'train': {'seconds': train_s, 'peak_mb': train_mb, 'images': nbr_train},
+                    'index': {'seconds': index_s, 'images_per_s': rate, 'peak_mb': index_mb,
+                              'db_mb': os.path.getsize(db) / 2.0**20},
+                    'searcher_query': sql_latency,
+                    'sparse_load': {'seconds': load_s, 'peak_mb': load_mb},
+                    'sparse_query': sparse_latency,
+                }
+                report['runs'].append(entry)
+                if verbose:
+                    print('k=%d n=%d: index %.0f images/s, Searcher p50 %.2fms p99 %.2fms, '
+                          'SparseSearcher p50 %.2fms p99 %.2fms' % (
+                              voc.nbr_words, n, rate, sql_latency['p50_ms'], sql_latency['p99_ms'],
+                              sparse_latency['p50_ms'], sparse_latency['p99_ms']))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='training / indexing / query scaling benchmark')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--synthetic', type=int, help='number of synthetic images')
+    source.add_argument('--folders', nargs='+', help='image folders, e.g. Town02/W000_P100_V000_P000/RGB')
+    parser.add_argument('--features', type=int, default=500, help='descriptors per synthetic image')
+    parser.add_argument('--max-images', type=int, default=None)
+    parser.add_argument('--vocab', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--db-sizes', type=int, nargs='+', default=[500, 2000])
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--trainer', default='minibatch', choices=['kmeans', 'minibatch'])
+    parser.add_argument('--subsampling', type=int, default=10)
+    parser.add_argument('--no-memory', action='store_true', help='do not trace allocations (tracing slows training down)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quantizers', action='store_true', help='only time vq against the Hamming assignment')
+    parser.add_argument('--max-descriptors', type=int, default=20000, help='descriptors used by --quantizers')
+    parser.add_argument('--out', default=None, help='JSON file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        names, des_list = synthetic_descriptors(args.synthetic, args.features, seed=args.seed)
+    else:
+        names, des_list = recorded_descriptors(args.folders, args.max_images)
+    if args.quantizers:
+        descriptors = np.concatenate([des for des in des_list if des is not None and len(des)])[:args.max_descriptors]
+        report = {'config': {'descriptors': len(descriptors), 'vocab_sizes': list(args.vocab), 'seed': args.seed},
+                  'platform': {'python': platform.python_version(), 'numpy': np.__version__,
+                               'machine': platform.machine()},
+                  'quantize': bench_quantizers(descriptors, args.vocab, not args.no_memory, args.seed)}
+    else:
+        report = run(names, des_list, args.vocab, args.db_sizes, args.queries, args.trainer, args.subsampling,
+                     not args.no_memory, args.seed, verbose=args.out is not None)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
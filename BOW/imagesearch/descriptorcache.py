@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import numpy as np
+from BOW.imagesearch.vocabulary import extract_features, ORB_PARAMS
+
+
+class DescriptorCache(object):
+
+    def __init__(self, cache_dir, feature='orb', params=None):
+        """ On-disk descriptor store. All descriptors live in one raw uint8
+            pool file that is memory-mapped for reading, an index maps
+            each image path to (mtime, size, first row, number of rows).
+            A separate pool is kept for every feature/parameter set. """
+
+        self.feature = feature
+        self.params = dict(ORB_PARAMS if params is None else params)
+        key = json.dumps([feature, self.params], sort_keys=True)
+        self.cache_dir = os.path.join(cache_dir, '%s_%s' % (feature, hashlib.md5(key.encode()).hexdigest()[:10]))
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.pool_path = os.path.join(self.cache_dir, 'pool.u8')
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+
+        self.width = 0
+        self.entries = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            self.width = index['width']
+            self.entries = index['entries']
+        self.pool = None
+        self._map_pool()
+
+    def _map_pool(self):
+        size = os.path.getsize(self.pool_path) if os.path.exists(self.pool_path) else 0
+        if size == 0 or self.width == 0:
+            self.pool = None
+        else:
+            self.pool = np.memmap(self.pool_path, dtype=np.uint8, mode='r',
+                                  shape=(size // self.width, self.width))
+
+    def _save_index(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'width': self.width, 'feature': self.feature,
+                       'params': self.params, 'entries': self.entries}, f)
+        os.replace(tmp, self.index_path)
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def is_fresh(self, path):
+        """ True if path is cached and unchanged on disk. """
+        entry = self.entries.get(path)
+        return entry is not None and tuple(entry[:2]) == self._stamp(path)
+
+    def _read(self, path):
+        mtime, size, offset, rows = self.entries[path]
+        if rows < 0:
+            return None  # extraction failed for this image
+        if rows == 0:
+            return np.zeros((0, self.width), dtype=np.uint8)
+        return self.pool[offset:offset + rows]
+
+    def _indexed_rows(self):
+        # 索引中记录的行数；之后的字节是中断的追加（索引未保存）留下的，不属于任何条目
+        return max([entry[2] + max(entry[3], 0) for entry in self.entries.values()] + [0])
+
+    def _append(self, items):
+        """ Append (path, (mtime, size), descriptors) items to the pool.
+            Bytes past the indexed rows are cut off first, so the new
+            rows start where the index says the pool ends. """
+        offset = self._indexed_rows()
+        self.pool = None
+        with open(self.pool_path, 'ab') as f:
+            f.truncate(offset * self.width)
+            for path, (mtime, size), des in items:
+                if des is None or len(des) == 0:
+                    self.entries[path] = [mtime, size, offset, -1 if des is None else 0]
+                    continue
+                des = np.ascontiguousarray(des, dtype=np.uint8)
+                self.width = des.shape[1]
+                f.write(des.tobytes())
+                self.entries[path] = [mtime, size, offset, des.shape[0]]
+                offset += des.shape[0]
+        self._save_index()
+        self._map_pool()
+
+    def put(self, paths, des_list):
+        """ Store descriptors for paths, stamped with their current mtime. """
+        self._append([(path, self._stamp(path), des) for path, des in zip(paths, des_list)])
+
+    def put_stream(self, items, chunk_size=64):
+        """ Pass (path, descriptors) pairs through, storing them every
+            chunk_size items (one index write per chunk). """
+        chunk = []
+        for path, des in items:
+            chunk.append((path, des))
+            yield path, des
+            if len(chunk) >= chunk_size:
+                self.put(*zip(*chunk))
+                chunk = []
+        if chunk:
+            self.put(*zip(*chunk))
+
+    def get(self, paths, workers=None):
+        """ Descriptors for paths in input order. Cached entries are
+            zero-copy views into the memory-mapped pool, missing or
+            modified images are extracted in parallel and appended. """
+
+        paths = list(paths)
+        missing = [path for path in paths if not self.is_fresh(path)]
+        if len(missing):
+            self.put(missing, extract_features(missing, self.feature, workers, params=self.params))
+        return [self._read(path) for path in paths]
+
+    def compact(self):
+        """ Rewrite the pool keeping only the rows still referenced. """
+        items = []
+        for path, entry in self.entries.items():
+            des = self._read(path)
+            items.append((path, tuple(entry[:2]), None if des is None else np.array(des)))
+        self.pool = None
+        if os.path.exists(self.pool_path):
+            os.remove(self.pool_path)
+        self.entries = {}
+        self._append(items)
@@ -1,10 +1,82 @@
 from numpy import *
+import numpy as np
+from scipy import sparse
 import pickle
+import time
+import builtins  # any/sum/min are shadowed by numpy's star import
 # from pysqlite2 import dbapi2 as sqlite
 from sqlite3 import dbapi2 as sqlite
 
-import operator
-from functools import cmp_to_key
+
+# magic prefix of the sparse histogram blobs stored in imhistograms
+HISTOGRAM_MAGIC = b'HST1'
+
+
+def idf_weights(idf):
+    """ Word weights of the searchers: idf floored at 0. A word that
+        occurs in (nearly) every indexed image has log(N/(df+1)) <= 0;
+        it cannot tell images apart, and a negative weight would make
+        squared distances negative. """
+    return np.maximum(np.asarray(idf, dtype=np.float64), 0)
+
+
+def encode_histogram(imwords):
+    """ Encode a word histogram as a sparse blob: the magic prefix, then
+        the nonzero word ids as little-endian uint32 followed by their
+        counts as little-endian float32. """
+    imwords = np.asarray(imwords)
+    words = imwords.nonzero()[0]
+    return HISTOGRAM_MAGIC + words.astype('<u4').tobytes() + imwords[words].astype('<f4').tobytes()
+
+
+def decode_sparse_histogram(blob):
+    """ (word ids, counts) of a sparse blob, zero-copy views on blob. """
+    if bytes(blob[:4]) != HISTOGRAM_MAGIC:
+        raise ValueError('not a sparse histogram blob, run migrate_histograms on the database')
+    n = (len(blob) - 4) // 8
+    words = np.frombuffer(blob, dtype='<u4', count=n, offset=4)
+    counts = np.frombuffer(blob, dtype='<f4', count=n, offset=4 + 4*n)
+    return words, counts
+
+
+def decode_histogram(blob,nbr_words,allow_pickle=False):
+    """ Dense histogram from a stored blob. Pickled blobs written by
+        older versions are only loaded with allow_pickle=True. """
+    if bytes(blob[:4]) != HISTOGRAM_MAGIC and allow_pickle:
+        return pickle.loads(blob)
+    words, counts = decode_sparse_histogram(blob)
+    imwords = np.zeros(nbr_words)
+    imwords[words] = counts
+    return imwords
+
+
+def migrate_histograms(db):
+    """ Convert a database written with pickled histograms in place:
+        histograms are re-encoded as sparse blobs and imwords is rebuilt
+        with one (imid,wordid,count) row per nonzero word. Returns the
+        number of converted histograms. Only run it on trusted files,
+        the old blobs have to be unpickled. """
+    con = sqlite.connect(db)
+    try:
+        columns = [r[1] for r in con.execute('pragma table_info(imwords)')]
+        rows = con.execute('select rowid, imid, histogram, vocname from imhistograms').fetchall()
+        nbr_converted = 0
+        with con:
+            if 'count' not in columns:
+                con.execute('alter table imwords add column count')
+            con.execute('delete from imwords')
+            for rowid, imid, blob, vocname in rows:
+                if bytes(blob[:4]) != HISTOGRAM_MAGIC:
+                    blob = encode_histogram(pickle.loads(blob))
+                    con.execute('update imhistograms set histogram=? where rowid=?', (blob, rowid))
+                    nbr_converted += 1
+                words, counts = decode_sparse_histogram(blob)
+                con.executemany('insert into imwords(imid,wordid,count,vocname) values (?,?,?,?)',
+                                [(imid,int(w),float(c),vocname) for w, c in zip(words, counts)])
+        con.execute('vacuum')
+    finally:
+        con.close()
+    return nbr_converted
 
 
 class Indexer(object):
@@ -26,11 +98,11 @@ class Indexer(object):
         """ Get an entry id and add if not present. """
         
         cur = self.con.execute(
-        "select rowid from imlist where filename='%s'" % imname)
+        "select rowid from imlist where filename=?", (imname,))
         res=cur.fetchone()
         if res==None:
             cur = self.con.execute(
-            "insert into imlist(filename) values ('%s')" % imname)
+            "insert into imlist(filename) values (?)", (imname,))
             return cur.lastrowid
         else:
             return res[0] 
@@ -38,9 +110,14 @@ class Indexer(object):
     def is_indexed(self,imname):
         """ Returns True if imname has been indexed. """
         
-        im = self.con.execute("select rowid from imlist where filename='%s'" % imname).fetchone()
+        im = self.con.execute("select rowid from imlist where filename=?", (imname,)).fetchone()
         return im != None
     
+    def word_rows(self,imid,imwords):
+        """ (imid,wordid,count,vocname) rows for the nonzero words. """
+        words = imwords.nonzero()[0]
+        return [(imid,int(w),float(imwords[w]),self.voc.name) for w in words]
+    
     def add_to_index(self,imname,descr):
         """ Take an image with feature descriptors, 
             project on vocabulary and add to database. """
@@ -53,23 +130,90 @@ class Indexer(object):
         
         # get the words
         imwords = self.voc.project(descr)
-        nbr_words = imwords.shape[0]
         
-        # link each word to image
-        for i in range(nbr_words):
-            word = imwords[i]
-            # wordid is the word number itself
-            self.con.execute("insert into imwords(imid,wordid,vocname) values (?,?,?)", (imid,word,self.voc.name))
+        # link each word to image, wordid is the word number itself
+        self.con.executemany("insert into imwords(imid,wordid,count,vocname) values (?,?,?,?)",
+                             self.word_rows(imid,imwords))
             
-        # store word histogram for image
-        # use pickle to encode NumPy arrays as strings
-        self.con.execute("insert into imhistograms(imid,histogram,vocname) values (?,?,?)", (imid,pickle.dumps(imwords),self.voc.name))
+        # store word histogram for image as a sparse blob
+        self.con.execute("insert into imhistograms(imid,histogram,vocname) values (?,?,?)", (imid,encode_histogram(imwords),self.voc.name))
+    
+    def set_pragmas(self,journal_mode='WAL',synchronous='NORMAL'):
+        """ Set sqlite journal mode and synchronous level for bulk writes. """
+        if journal_mode is not None:
+            if journal_mode.upper() not in ('DELETE','TRUNCATE','PERSIST','MEMORY','WAL','OFF'):
+                raise ValueError('unknown journal_mode %s' % journal_mode)
+            self.con.execute('pragma journal_mode=%s' % journal_mode)
+        if synchronous is not None:
+            if str(synchronous).upper() not in ('OFF','NORMAL','FULL','EXTRA','0','1','2','3'):
+                raise ValueError('unknown synchronous %s' % synchronous)
+            self.con.execute('pragma synchronous=%s' % synchronous)
+    
+    def indexed_names(self):
+        """ Set of all indexed filenames, read in one query. """
+        return set(r[0] for r in self.con.execute('select filename from imlist'))
+    
+    def add_batch(self,items,journal_mode='WAL',synchronous='NORMAL',chunk_size=500,verbose=True,df=None,
+                  commit_chunks=False):
+        """ Bulk index an iterable of (imname, descr) pairs in one
+            transaction. Already indexed names are skipped, only nonzero
+            words are written and rows go in with executemany. If df is
+            an array of per-word document counts, the words of every
+            newly indexed image are added to it in place. With
+            commit_chunks every chunk_size images are committed, so
+            readers see them while a long (streamed) batch goes on.
+            Returns (number of images indexed, images/sec). """
+        
+        t0 = time.perf_counter()
+        self.set_pragmas(journal_mode, synchronous)
+        indexed = self.indexed_names()
+        
+        nbr_images = 0
+        word_rows, hist_rows = [], []
+        with self.con:
+            for imname, descr in items:
+                if imname in indexed: continue
+                indexed.add(imname)
+                imid = self.con.execute("insert into imlist(filename) values (?)", (imname,)).lastrowid
+                imwords = self.voc.project(descr)
+                if df is not None:
+                    df[imwords > 0] += 1
+                word_rows += self.word_rows(imid,imwords)
+                hist_rows.append((imid,encode_histogram(imwords),self.voc.name))
+                nbr_images += 1
+                if len(hist_rows) >= chunk_size:
+                    self._flush(word_rows,hist_rows)
+                    word_rows, hist_rows = [], []
+                    if commit_chunks:
+                        self.con.commit()
+            self._flush(word_rows,hist_rows)
+        
+        elapsed = time.perf_counter() - t0
+        rate = nbr_images/elapsed if elapsed > 0 else 0.0
+        if verbose:
+            print('indexed', nbr_images, 'images in %.2fs (%.1f images/sec)' % (elapsed, rate))
+        return nbr_images, rate
+    
+    def _flush(self,word_rows,hist_rows):
+        self.con.executemany("insert into imwords(imid,wordid,count,vocname) values (?,?,?,?)", word_rows)
+        self.con.executemany("insert into imhistograms(imid,histogram,vocname) values (?,?,?)", hist_rows)
     
-    def create_tables(self): 
-        """ Create the database tables. """
+    def create_tables(self,drop=True): 
+        """ Create the database tables. With drop=False existing
+            tables and their rows are kept (incremental indexing). """
+        if not drop:
+            self.con.execute('create table if not exists imlist(filename)')
+            self.con.execute('create table if not exists imwords(imid,wordid,count,vocname)')
+            self.con.execute('create table if not exists imhistograms(imid,histogram,vocname)')
+            self.con.execute('create index if not exists im_idx on imlist(filename)')
+            self.con.execute('create index if not exists wordid_idx on imwords(wordid)')
+            self.con.execute('create index if not exists imid_idx on imwords(imid)')
+            self.con.execute('create index if not exists imidhist_idx on imhistograms(imid)')
+            self.db_commit()
+            return
         try:
             self.con.execute('create table imlist(filename)')
-            self.con.execute('create table imwords(imid,wordid,vocname)')
+            self.con.execute('create table imwords(imid,wordid,count,vocname)')
             self.con.execute('create table imhistograms(imid,histogram,vocname)')
             self.con.execute('create index im_idx on imlist(filename)')
             self.con.execute('create index wordid_idx on imwords(wordid)')
@@ -81,7 +225,7 @@ class Indexer(object):
             self.con.execute('drop table imwords')
             self.con.execute('drop table imhistograms')
             self.con.execute('create table imlist(filename)')
-            self.con.execute('create table imwords(imid,wordid,vocname)')
+            self.con.execute('create table imwords(imid,wordid,count,vocname)')
             self.con.execute('create table imhistograms(imid,histogram,vocname)')
             self.con.execute('create index im_idx on imlist(filename)')
             self.con.execute('create index wordid_idx on imwords(wordid)')
@@ -94,10 +238,13 @@ class Indexer(object):
 
 class Searcher(object):
     
-    def __init__(self,db,voc):
-        """ Initialize with the name of the database. """
+    def __init__(self,db,voc,allow_pickle=False,max_candidates=None):
+        """ Initialize with the name of the database. max_candidates
+            caps how many images (top by shared words) are scored. """
         self.con = sqlite.connect(db)
         self.voc = voc
+        self.allow_pickle = allow_pickle
+        self.max_candidates = max_candidates
     
     def __del__(self):
         self.con.close()
@@ -106,55 +253,69 @@ class Searcher(object):
         """ Return the word histogram for an image. """
         
         im_id = self.con.execute(
-            "select rowid from imlist where filename='%s'" % imname).fetchone()
+            "select rowid from imlist where filename=?", (imname,)).fetchone()
         s = self.con.execute(
-            "select histogram from imhistograms where rowid='%d'" % im_id).fetchone()
+            "select histogram from imhistograms where imid=?", im_id).fetchone()
         
-        # use pickle to decode NumPy arrays from string
-        return pickle.loads(s[0])
+        return decode_histogram(s[0],self.voc.nbr_words,self.allow_pickle)
     
     def candidates_from_word(self,imword):
         """ Get list of images containing imword. """
         
         im_ids = self.con.execute(
-            "select distinct imid from imwords where wordid=%d" % imword).fetchall()
+            "select distinct imid from imwords where wordid=?", (int(imword),)).fetchall()
         return [i[0] for i in im_ids]
 
 
     def candidates_from_histogram(self,imwords):
-        """ Get list of images with similar words. """
+        """ Get list of images with similar words, most shared words
+            first (ties by imid), at most max_candidates of them. """
         
         # get the word ids
-        words = imwords.nonzero()[0]
+        words = [int(w) for w in imwords.nonzero()[0]]
         
-        # find candidates
-        candidates = []
-        for word in words:
-            c = self.candidates_from_word(word)
-            candidates+=c
+        # one pass over the (imid,wordid) rows of all query words
+        im_ids = []
+        for start in range(0, len(words), 900):  # sqlite host parameter limit
+            chunk = words[start:start+900]
+            im_ids += self.con.execute(
+                "select imid from imwords where wordid in (%s)" % ','.join('?'*len(chunk)), chunk).fetchall()
+        if not len(im_ids):
+            return []
         
-        # take all unique words and reverse sort on occurrence 
-        tmp = [(w,candidates.count(w)) for w in set(candidates)]
-        # tmp.sort(cmp=lambda x,y:cmp(x[1],y[1]))
-        # tmp.sort(key=lambda x: x[1])
-        tmp.sort(key=cmp_to_key(lambda x, y: operator.gt(x[1], y[1])))
-        tmp.reverse()
+        # count shared words per image and reverse sort on occurrence
+        counts = np.bincount(np.array(im_ids, dtype=np.int64).ravel())
+        candidates = counts.nonzero()[0]
+        order = np.lexsort((candidates, -counts[candidates]))
+        if self.max_candidates is not None:
+            order = order[:self.max_candidates]
         
         # return sorted list, best matches first    
-        return [w[0] for w in tmp] 
+        return candidates[order].tolist()
+    
+    def get_imhistograms(self,imids):
+        """ Return {imid: histogram} for many images in one query. """
+        
+        res = {}
+        for start in range(0, len(imids), 900):
+            chunk = [int(i) for i in imids[start:start+900]]
+            rows = self.con.execute(
+                "select imid, histogram from imhistograms where imid in (%s)" % ','.join('?'*len(chunk)), chunk).fetchall()
+            for imid, blob in rows:
+                res[imid] = decode_histogram(blob,self.voc.nbr_words,self.allow_pickle)
+        return res
     
     def query(self,imname):
         """ Find a list of matching images for imname. """
         
         h = self.get_imhistogram(imname)
         candidates = self.candidates_from_histogram(h)
+        cand_h = self.get_imhistograms(candidates)
         
+        idf = idf_weights(self.voc.idf)
         matchscores = []
         for imid in candidates:
-            # get the name
-            cand_name = self.con.execute("select filename from imlist where rowid=%d" % imid).fetchone()
-            cand_h = self.get_imhistogram(cand_name)
-            cand_dist = sqrt( sum( self.voc.idf*(h-cand_h)**2 ) )
+            cand_dist = sqrt( sum( idf*(h-cand_h[imid])**2 ) )
             matchscores.append( (cand_dist,imid) )
         
         # return a sorted list of distances and database ids
@@ -165,16 +326,170 @@ class Searcher(object):
         """ Return the filename for an image id. """
         
         s = self.con.execute(
-            "select filename from imlist where rowid='%d'" % imid).fetchone()
+            "select filename from imlist where rowid=?", (int(imid),)).fetchone()
         return s[0]
 
 
+class SparseSearcher(object):
+    
+    def __init__(self,db,voc,allow_pickle=False,max_candidates=None,shard=None):
+        """ Initialize with the name of the database and load every
+            image histogram once into an in-memory sparse index. With
+            shard (a list of strings) only images whose filename contains
+            one of them are loaded; shard may also be a function of the
+            filename returning True for the images to load. """
+        self.db = db
+        self.voc = voc
+        self.allow_pickle = allow_pickle
+        self.max_candidates = max_candidates
+        self.shard = shard
+        self.load()
+    
+    def load(self):
+        """ Read imlist/imhistograms and build the CSR histogram matrix
+            (image x word) and the inverted index (word x image). """
+        con = sqlite.connect(self.db)
+        try:
+            rows = con.execute(
+                "select imlist.rowid, imlist.filename, imhistograms.histogram "
+                "from imlist join imhistograms on imhistograms.imid = imlist.rowid "
+                "order by imlist.rowid").fetchall()
+        finally:
+            con.close()
+        if callable(self.shard):
+            rows = [r for r in rows if self.shard(r[1])]
+        elif self.shard is not None:
+            rows = [r for r in rows if builtins.any(part in r[1] for part in self.shard)]
+        
+        nbr_words = len(self.voc.idf)
+        self.imids = np.array([r[0] for r in rows], dtype=np.int64)
+        self.filenames = [r[1] for r in rows]
+        self.row_of = dict(zip(self.filenames, range(len(rows))))
+        
+        # the sparse blobs are already csr rows: concatenate word ids and counts
+        indices, data = [], []
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        for i, r in enumerate(rows):
+            if bytes(r[2][:4]) != HISTOGRAM_MAGIC:
+                h = decode_histogram(r[2], nbr_words, self.allow_pickle)
+                words, counts = h.nonzero()[0], h[h.nonzero()[0]]
+            else:
+                words, counts = decode_sparse_histogram(r[2])
+            indices.append(words)
+            data.append(counts)
+            indptr[i+1] = indptr[i] + len(words)
+        self.histograms = sparse.csr_matrix(
+            (np.concatenate(data + [np.zeros(0)]).astype(np.float64),
+             np.concatenate(indices + [np.zeros(0, dtype=np.int64)]).astype(np.int64), indptr),
+            shape=(len(rows), nbr_words))
+        self._build_index()
+    
+    def _build_index(self):
+        """ Precompute the tf-idf weighted norms and the inverted index. """
+        self.idf = idf_weights(self.voc.idf)
+        h = self.histograms
+        # sum(idf*c**2) for every database image
+        self.norms = np.asarray(h.multiply(h).dot(self.idf)).ravel()
+        # CSR over words: row w lists the images containing word w
+        self.inverted = h.T.tocsr()
+        self.inverted.data[:] = 1
+    
+    def get_imhistogram(self,imname):
+        """ Return the word histogram for an image. """
+        return self.histograms[self.row_of[imname]].toarray().ravel()
+    
+    def get_filename(self,imid):
+        """ Return the filename for an image id. """
+        return self.filenames[np.searchsorted(self.imids, imid)]
+    
+    def candidates_from_histogram(self,imwords):
+        """ Get the rows of all images sharing at least one word, or
+            the max_candidates rows sharing the most words. """
+        words = np.asarray(imwords).nonzero()[0]
+        rows = self.inverted[words].indices
+        if self.max_candidates is None:
+            return np.unique(rows)
+        counts = np.bincount(rows, minlength=len(self.filenames))
+        rows = counts.nonzero()[0]
+        order = np.lexsort((rows, -counts[rows]))[:self.max_candidates]
+        return np.sort(rows[order])
+    
+    def score(self,h,rows=None):
+        """ tf-idf weighted distance from h to database rows, computed
+            as one sparse matrix product. """
+        h = np.asarray(h, dtype=np.float64)
+        hists = self.histograms if rows is None else self.histograms[rows]
+        norms = self.norms if rows is None else self.norms[rows]
+        dots = hists.dot(self.idf*h)
+        d2 = np.dot(self.idf, h**2) + norms - 2*dots
+        return np.sqrt(np.maximum(d2, 0))  # weights are >= 0: only rounding below 0
+    
+    def query_histogram(self,h):
+        """ Find a sorted list of (distance, imid) for a histogram. """
+        rows = self.candidates_from_histogram(h)
+        dist = self.score(h, rows)
+        imids = self.imids[rows]
+        order = np.lexsort((imids, dist))
+        return list(zip(dist[order].tolist(), imids[order].tolist()))
+    
+    def restrict_mask(self,restrict_to):
+        """ Boolean mask of database rows whose filename contains
+            restrict_to (a string or a list of strings). """
+        if restrict_to is None:
+            return np.ones(len(self.filenames), dtype=bool)
+        if isinstance(restrict_to, str):
+            restrict_to = [restrict_to]
+        names = np.array(self.filenames, dtype=str)
+        mask = np.zeros(len(self.filenames), dtype=bool)
+        for part in restrict_to:
+            mask |= np.char.find(names, part) >= 0
+        return mask
+    
+    def query_batch(self,hists,k=5,restrict_to=None,chunk_size=256):
+        """ Top-k (distance, imid) lists for many histograms at once.
+            Distances for a chunk of queries are one matrix product,
+            the k best are picked with argpartition instead of a full
+            sort. Only images sharing a word with the query and matching
+            restrict_to are returned. """
+        if len(hists) == 0:
+            return []
+        hists = np.atleast_2d(np.asarray(hists, dtype=np.float64))
+        allowed = self.restrict_mask(restrict_to)
+        results = []
+        for start in range(0, hists.shape[0], chunk_size):
+            q = hists[start:start+chunk_size]
+            dots = self.histograms.dot((q*self.idf).T).T
+            d2 = (q**2).dot(self.idf)[:,None] + self.norms[None,:] - 2*dots
+            dist = np.sqrt(np.maximum(d2, 0))  # weights are >= 0: only rounding below 0
+            shared = sparse.csr_matrix((q > 0)*1.0).dot(self.inverted)
+            dist[(shared.toarray() == 0) | ~allowed[None,:]] = np.inf
+            kk = k if k < dist.shape[1] else dist.shape[1]
+            if kk == 0:
+                results += [[] for _ in range(q.shape[0])]
+                continue
+            if kk < dist.shape[1]:
+                top = np.argpartition(dist, kk-1, axis=1)[:,:kk]
+            else:
+                top = np.tile(np.arange(dist.shape[1]), (q.shape[0],1))
+            for i in range(q.shape[0]):
+                rows = top[i][np.isfinite(dist[i,top[i]])]
+                d, imids = dist[i,rows], self.imids[rows]
+                order = np.lexsort((imids, d))
+                results.append(list(zip(d[order].tolist(), imids[order].tolist())))
+        return results
+    
+    def query(self,imname):
+        """ Find a list of matching images for imname, same as
+            Searcher.query but without touching the database. """
+        return self.query_histogram(self.get_imhistogram(imname))
+
+
 def tf_idf_dist(voc,v1,v2):
     
     v1 /= sum(v1)
     v2 /= sum(v2)
     
-    return sqrt( sum( voc.idf*(v1-v2)**2 ) )
+    return sqrt( sum( idf_weights(voc.idf)*(v1-v2)**2 ) )
 
 
 def compute_ukbench_score(src,imlist):
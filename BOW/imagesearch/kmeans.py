@@ -0,0 +1,91 @@
+import numpy as np
+
+
+def sq_distances(x, centroids):
+    """ Squared Euclidean distances between rows of x and centroids. """
+    x = np.asarray(x, dtype=np.float64)
+    d = (x ** 2).sum(axis=1)[:, None] + (centroids ** 2).sum(axis=1)[None, :] - 2 * x.dot(centroids.T)
+    return np.maximum(d, 0)
+
+
+def assign(x, centroids, chunk_size=4096):
+    """ Nearest centroid and its Euclidean distance for every row of x. """
+    words = np.empty(len(x), dtype=np.int64)
+    dist = np.empty(len(x))
+    for start in range(0, len(x), chunk_size):
+        d = sq_distances(x[start:start + chunk_size], centroids)
+        words[start:start + chunk_size] = d.argmin(axis=1)
+        dist[start:start + chunk_size] = np.sqrt(d.min(axis=1))
+    return words, dist
+
+
+def kmeans_plusplus(data, k, rng, init_size=None):
+    """ k-means++ seeding: each new centroid is drawn with probability
+        proportional to its squared distance to the nearest one chosen.
+        Runs on a random sample of init_size rows (default 10*k). """
+
+    n = len(data)
+    init_size = min(n, 10 * k if init_size is None else init_size)
+    sample = np.asarray(data[np.sort(rng.choice(n, init_size, replace=False))], dtype=np.float64)
+
+    centroids = np.empty((k, sample.shape[1]))
+    centroids[0] = sample[rng.integers(init_size)]
+    closest = sq_distances(sample, centroids[:1]).ravel()
+    for i in range(1, k):
+        total = closest.sum()
+        if total > 0:
+            j = rng.choice(init_size, p=closest / total)
+        else:
+            j = rng.integers(init_size)
+        centroids[i] = sample[j]
+        closest = np.minimum(closest, sq_distances(sample, centroids[i:i + 1]).ravel())
+    return centroids
+
+
+def minibatch_kmeans(data, k, batch_size=1024, max_iter=200, tol=1e-4, patience=10,
+                     init_size=None, seed=None, verbose=False):
+    """ Mini-batch k-means (Sculley 2010) with k-means++ seeding.
+        data can be any row-indexable array, e.g. a uint8 memmap; only
+        one batch at a time is converted to float. Training stops after
+        max_iter batches, or when the smoothed batch distortion has not
+        improved by more than tol (relative) for patience batches.
+        Returns (centroids, distortion, history), distortion being the
+        mean Euclidean distance to the nearest centroid over data as in
+        scipy.cluster.vq.kmeans and history the per-batch distortion. """
+
+    rng = np.random.default_rng(seed)
+    n = len(data)
+    if k > n:
+        raise ValueError('k=%d is larger than the number of descriptors %d' % (k, n))
+
+    centroids = kmeans_plusplus(data, k, rng, init_size)
+    counts = np.zeros(k)
+    history = []
+    smoothed, best, stale = None, np.inf, 0
+    for it in range(max_iter):
+        idx = np.sort(rng.choice(n, min(batch_size, n), replace=False))
+        batch = np.asarray(data[idx], dtype=np.float64)
+        words, dist = assign(batch, centroids)
+        history.append(float(dist.mean()))
+
+        # per-centroid learning rate 1/count: move towards the batch mean
+        batch_counts = np.bincount(words, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, words, batch)
+        hit = batch_counts > 0
+        counts[hit] += batch_counts[hit]
+        centroids[hit] += (sums[hit] - batch_counts[hit][:, None] * centroids[hit]) / counts[hit][:, None]
+
+        alpha = min(1.0, 2.0 * len(batch) / n)
+        smoothed = history[-1] if smoothed is None else (1 - alpha) * smoothed + alpha * history[-1]
+        if verbose:
+            print('iteration', it, 'distortion', history[-1], 'smoothed', smoothed)
+        if smoothed < best * (1 - tol):
+            best, stale = smoothed, 0
+        else:
+            stale += 1
+            if stale >= patience:
+                break
+
+    distortion = float(assign(data, centroids)[1].mean())
+    return centroids, distortion, history
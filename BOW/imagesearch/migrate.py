@@ -0,0 +1,20 @@
+""" Convert imagesearch databases with pickled histograms to the sparse
+    blob format, e.g.
+
+    python -m BOW.imagesearch.migrate ImaAdd.db
+"""
+import sys
+import argparse
+from BOW.imagesearch.imagesearch import migrate_histograms
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='migrate pickled imhistograms to sparse blobs')
+    parser.add_argument('databases', nargs='+', help='sqlite database files written by Indexer')
+    args = parser.parse_args(argv)
+    for db in args.databases:
+        print(db, 'converted', migrate_histograms(db), 'histograms')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
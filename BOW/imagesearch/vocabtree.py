@@ -0,0 +1,85 @@
+import numpy as np
+from BOW.imagesearch.kmeans import minibatch_kmeans
+
+
+class VocabularyTree(object):
+
+    def __init__(self, branching=10, depth=3, seed=None, trainer_options=None):
+        """ Hierarchical k-means vocabulary (Nister & Stewenius 2006).
+            Every node is split into branching children down to depth
+            levels, giving branching**depth words. Projecting a descriptor
+            costs branching*depth distance computations instead of one
+            per word. The tree is kept complete: centers[l] holds the
+            branching**(l+1) centers of level l, children of node j at
+            rows j*branching ... (j+1)*branching-1. """
+
+        self.branching = branching
+        self.depth = depth
+        self.seed = seed
+        self.trainer_options = dict(trainer_options or {})
+        self.centers = []
+
+    @property
+    def nbr_words(self):
+        return self.branching ** self.depth
+
+    @property
+    def leaves(self):
+        """ Centers of the words, in word order. """
+        return self.centers[-1]
+
+    def _split(self, rows, parent, rng):
+        """ branching centers for the descriptors of one node. """
+        b = self.branching
+        if len(rows) == 0:
+            return np.tile(parent, (b, 1))
+        if len(rows) <= b:
+            # too few descriptors to cluster, pad with the first one
+            centers = np.asarray(rows, dtype=np.float64)
+            return np.vstack([centers, np.tile(centers[0], (b - len(rows), 1))])
+        options = dict(self.trainer_options)
+        options.setdefault('seed', int(rng.integers(2 ** 31)))
+        return minibatch_kmeans(rows, b, **options)[0]
+
+    def fit(self, data, chunk_size=4096):
+        """ Build the tree level by level on data (n x dim). """
+        rng = np.random.default_rng(self.seed)
+        data = np.asarray(data)
+        self.centers = []
+        node_of = np.zeros(len(data), dtype=np.int64)
+        # 根节点中心：分块累加，不生成整个训练矩阵的 float64 副本
+        total = np.zeros(data.shape[1], dtype=np.float64)
+        for start in range(0, len(data), chunk_size):
+            total += data[start:start + chunk_size].sum(axis=0, dtype=np.float64)
+        parents = [total / max(len(data), 1)]
+        for level in range(self.depth):
+            order = np.argsort(node_of, kind='stable')
+            bounds = np.searchsorted(node_of[order], np.arange(len(parents) + 1))
+            level_centers = [self._split(data[order[bounds[j]:bounds[j + 1]]], parents[j], rng)
+                             for j in range(len(parents))]
+            self.centers.append(np.vstack(level_centers))
+            parents = list(self.centers[-1])
+            # 分块下降，n x b x dim 的距离数组只按 chunk_size 行分配
+            for start in range(0, len(data), chunk_size):
+                node_of[start:start + chunk_size] = self._descend_level(
+                    data[start:start + chunk_size], node_of[start:start + chunk_size], level)
+        return self
+
+    def _descend_level(self, x, node, level):
+        """ Child index at level for descriptors currently at node. """
+        b = self.branching
+        children = node[:, None] * b + np.arange(b)[None, :]
+        c = self.centers[level][children]  # n x b x dim
+        d = ((c - np.asarray(x, dtype=np.float64)[:, None, :]) ** 2).sum(axis=2)
+        return children[np.arange(len(x)), d.argmin(axis=1)]
+
+    def words(self, descriptors, chunk_size=4096):
+        """ Word (leaf) id for every descriptor. """
+        words = np.empty(len(descriptors), dtype=np.int64)
+        for start in range(0, len(descriptors), chunk_size):
+            x = descriptors[start:start + chunk_size]
+            node = np.zeros(len(x), dtype=np.int64)
+            for level in range(self.depth):
+                node = self._descend_level(x, node, level)
+            words[start:start + chunk_size] = node
+        return words
@@ -1,62 +1,203 @@
 import numpy as np
 from scipy.cluster.vq import *
+from scipy import sparse
+from multiprocessing import Pool
 import cv2
+from BOW.imagesearch.kmeans import minibatch_kmeans
+from BOW.imagesearch.vocabtree import VocabularyTree
+from BOW.imagesearch import hamming
+
+# keyword arguments for cv2.ORB_create, shared by every extractor
+ORB_PARAMS = {}
 
 
 class Vocabulary(object):
-    def __init__(self, name, feature):
+    def __init__(self, name, feature, trainer='kmeans', trainer_options=None, tree=None, metric='euclidean'):
+        """trainer: 'kmeans' (scipy, full batch) 或 'minibatch'（小批量k-means++，参数见trainer_options）"""
+        """tree: (branching, depth) 时训练词汇树，单词数为 branching**depth，train 的 k 被忽略"""
+        """metric: 'hamming' 时保持 ORB 二进制描述子，用 k-majority 聚类、汉明距离投影"""
         self.feature = feature
         self.name = name
         self.voc = []
         self.idf = []
         self.trainingdata = []
         self.nbr_words = 0
+        self.trainer = trainer
+        self.trainer_options = dict(trainer_options or {})
+        self.distortion = None
+        self.distortion_history = []
+        self.tree_shape = tree
+        self.tree = None
+        self.metric = metric
+        self.nbr_occurences = None  # 每个单词的文档频数，增量更新 idf 用
+        self.nbr_images = 0
+
+    def __setstate__(self, state):
+        # vocabularies pickled before the trainer options existed
+        self.__dict__.update(state)
+        self.__dict__.setdefault('trainer', 'kmeans')
+        self.__dict__.setdefault('trainer_options', {})
+        self.__dict__.setdefault('distortion', None)
+        self.__dict__.setdefault('distortion_history', [])
+        self.__dict__.setdefault('tree_shape', None)
+        self.__dict__.setdefault('tree', None)
+        self.__dict__.setdefault('metric', 'euclidean')
+        if 'nbr_occurences' not in self.__dict__:
+            # recover document frequencies from idf = log(N/(df+1))
+            self.nbr_images = len(self.trainingdata)
+            self.nbr_occurences = None
+            if len(self.idf):
+                self.nbr_occurences = np.round(self.nbr_images*np.exp(-np.asarray(self.idf)) - 1).astype(np.int64)
 
-    def train(self, featurefiles, k, subsampling=10):
+    def train(self, featurefiles, k, subsampling=10, workers=None, des_list=None, cache=None,
+              max_descriptors=None, seed=None):
         """使用k个单词数为k的均值，从特征文件中列出的文件中的特征训练词汇。"""
         """训练数据的下采样（subsampling）可用于加速"""
         """k为聚类中心数（词汇单词数）"""
+        """des_list: 已提取的特征（与featurefiles顺序一致），为None时从cache（DescriptorCache）读取或用workers个进程提取"""
+        """max_descriptors: 参与聚类的描述子上限（蓄水池采样），用于限制内存峰值"""
 
         nbr_images = len(featurefiles)
-        des_list = []  # 特征描述
-        descriptors = np.zeros((1, 32))
-        for path in featurefiles:
-            des = extract_feature(path, feature=self.feature)
-            if des is not None:
-                descriptors = np.row_stack((descriptors, des))
-            des_list.append(des)
-        descriptors = descriptors[1:, :]  # the des matrix of orb
-
-        # K-means: 最后一个参数决定kmeans运行次数
-        self.voc, distortion = kmeans(descriptors[::subsampling, :], k, 4)
+        if des_list is None and cache is not None:
+            des_list = cache.get(featurefiles, workers=workers)
+        elif des_list is None:
+            des_list = extract_features(featurefiles, feature=self.feature, workers=workers)  # 特征描述
+        # the subsampled des matrix of orb, uint8 until it is handed to kmeans
+        descriptors = collect_descriptors(des_list, subsampling, max_descriptors, seed)
+
+        if self.metric == 'hamming':
+            if self.tree_shape is not None:
+                raise ValueError('vocabulary tree is not supported with the hamming metric')
+            # 二进制词汇：k-majority 聚类，单词为 uint8 二进制中心
+            self.voc, self.distortion, self.distortion_history = hamming.kmajority(
+                descriptors, k, seed=seed, **self.trainer_options)
+        elif self.tree_shape is not None:
+            # 词汇树：层次k-means，叶节点为单词
+            branching, depth = self.tree_shape
+            self.tree = VocabularyTree(branching, depth, seed, self.trainer_options).fit(descriptors)
+            self.voc = self.tree.leaves
+        elif self.trainer == 'minibatch':
+            # 小批量 k-means，直接在 uint8 描述子上分批训练
+            options = dict(self.trainer_options)
+            options.setdefault('seed', seed)
+            self.voc, self.distortion, self.distortion_history = minibatch_kmeans(descriptors, k, **options)
+        else:
+            # K-means: 最后一个参数决定kmeans运行次数
+            self.voc, self.distortion = kmeans(descriptors.astype(np.float64), k, 4)
         self.nbr_words = self.voc.shape[0]
 
-        # 遍历所有的训练图像，并投影到词汇上
-        imwords = np.zeros((nbr_images, self.nbr_words))
-        for i in range(nbr_images):
-            imwords[i] = self.project(des_list[i])
+        # 所有训练图像一次投影到词汇上（稀疏直方图矩阵）
+        imwords = self.project_batch(des_list)
 
-        nbr_occurences = np.sum((imwords > 0) * 1, axis=0)
-        self.idf = np.log((1.0 * nbr_images) / (1.0 * nbr_occurences + 1))
+        # 每个单词出现在多少幅图像中：csr 每行每个单词只出现一次
+        self.nbr_occurences = np.bincount(imwords.indices, minlength=self.nbr_words)
+        self.nbr_images = nbr_images
+        self.update_idf()
         self.trainingdata = featurefiles
 
+    def update_idf(self, nbr_occurences=None, nbr_images=0, reset=False):
+        """ Add document frequencies of nbr_images new images (per-word
+            counts of images containing the word) and recompute idf
+            without touching the codebook. reset replaces the counts
+            (e.g. of the training images) instead of adding to them. """
+        if nbr_occurences is not None:
+            if reset:
+                self.nbr_occurences = np.zeros(self.nbr_words, dtype=np.int64)
+                self.nbr_images = 0
+            self.nbr_occurences = self.nbr_occurences + np.asarray(nbr_occurences, dtype=np.int64)
+            self.nbr_images += nbr_images
+        self.idf = np.log((1.0 * self.nbr_images) / (1.0 * self.nbr_occurences + 1))
+
     def project(self, descriptors):
         """ 将描述子投影到词汇上，以创建单词直方图  """
         # 图像单词直方图
-        imhist = np.zeros((self.nbr_words))
-        words, distance = vq(descriptors, self.voc)
-        for w in words:
-            imhist[w] += 1
-        return imhist
+        if descriptors is None or len(descriptors) == 0:
+            return np.zeros((self.nbr_words))
+        words = self.get_words(descriptors)
+        return np.bincount(words, minlength=self.nbr_words).astype(np.float64)
+
+    def project_batch(self, des_list, chunk_size=256):
+        """ Histograms of many images as a sparse (images x words) csr matrix.
+            Descriptors of chunk_size images are quantized in one call and
+            counted with a single bincount-style coo -> csr conversion. """
+        rows, cols = [], []
+        for start in range(0, len(des_list), chunk_size):
+            chunk = des_list[start:start + chunk_size]
+            lengths = np.array([0 if des is None else len(des) for des in chunk])
+            if lengths.sum() == 0:
+                continue
+            words = self.get_words(collect_descriptors(chunk))
+            rows.append(start + np.repeat(np.arange(len(chunk)), lengths))
+            cols.append(words)
+        if not len(rows):
+            return sparse.csr_matrix((len(des_list), self.nbr_words))
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        hists = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                  shape=(len(des_list), self.nbr_words))
+        hists.sum_duplicates()
+        return hists
 
     def get_words(self, descriptors):
         """ Convert descriptors to words. """
+        if self.metric == 'hamming':
+            return hamming.nearest(descriptors, self.voc)[0]
+        if self.tree is not None:
+            return self.tree.words(descriptors)
         return vq(descriptors, self.voc)[0]
 
-def extract_feature(path, feature='orb'):
-    if feature is 'orb':
+def collect_descriptors(des_list, subsampling=1, max_descriptors=None, seed=None):
+    """ Stack every subsampling-th descriptor row, counted over all images
+        like descriptors[::subsampling] on the full matrix, into one
+        preallocated uint8 buffer. With max_descriptors the buffer is capped
+        and filled by reservoir sampling over the subsampled stream. """
+
+    des_list = [des for des in des_list if des is not None and len(des)]
+    if not len(des_list):
+        return np.zeros((0, 32), dtype=np.uint8)
+    width = des_list[0].shape[1]
+
+    # first kept row of each image and the number of kept rows
+    offsets = np.cumsum([0] + [len(des) for des in des_list[:-1]])
+    starts = (-offsets) % subsampling
+    counts = [max(0, -(-(len(des) - start) // subsampling)) for des, start in zip(des_list, starts)]
+    total = int(np.sum(counts))
+
+    if max_descriptors is None or total <= max_descriptors:
+        descriptors = np.empty((total, width), dtype=np.uint8)
+        row = 0
+        for des, start, count in zip(des_list, starts, counts):
+            descriptors[row:row + count] = des[start::subsampling]
+            row += count
+        return descriptors
+
+    rng = np.random.default_rng(seed)
+    descriptors = np.empty((max_descriptors, width), dtype=np.uint8)
+    seen = 0
+    for des, start in zip(des_list, starts):
+        rows = des[start::subsampling]
+        fill = min(max(max_descriptors - seen, 0), len(rows))
+        descriptors[seen:seen + fill] = rows[:fill]
+        if fill < len(rows):
+            # reservoir sampling: row number i replaces a random slot with probability max/(i+1)
+            slots = rng.integers(0, np.arange(seen + fill, seen + len(rows)) + 1)
+            keep = slots < max_descriptors
+            descriptors[slots[keep]] = rows[fill:][keep]
+        seen += len(rows)
+    return descriptors
+
+
+def create_detector(feature='orb', params=None):
+    if feature == 'orb':
+        return cv2.ORB_create(**(ORB_PARAMS if params is None else params))
+    else:
+        # add other features
+        pass
+
+
+def extract_feature(path, feature='orb', detector=None):
+    if feature == 'orb':
         try:
-            orb = cv2.ORB_create()
+            orb = detector if detector is not None else create_detector(feature)
             img = cv2.imread(path)
             gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
             # find the keypoints with ORB
@@ -70,3 +211,48 @@ def extract_feature(path, feature='orb'):
         # add other features
         pass
 
+
+# per-process detector, created once by the pool initializer
+_worker_feature = None
+_worker_detector = None
+
+
+def _init_worker(feature, params):
+    global _worker_feature, _worker_detector
+    cv2.setNumThreads(1)
+    _worker_feature = feature
+    _worker_detector = create_detector(feature, params)
+
+
+def _extract_worker(path):
+    return extract_feature(path, _worker_feature, _worker_detector)
+
+
+def _extract_pair_worker(path):
+    return path, extract_feature(path, _worker_feature, _worker_detector)
+
+
+def iter_features(paths, feature='orb', workers=None, chunksize=4, params=None):
+    """ Streaming extract_features: paths may be a generator that is still
+        producing (e.g. files being ingested), (path, descriptors) pairs
+        are yielded in input order as soon as they are extracted. """
+    if workers == 1:
+        detector = create_detector(feature, params)
+        for path in paths:
+            yield path, extract_feature(path, feature, detector)
+        return
+    with Pool(workers, initializer=_init_worker, initargs=(feature, params)) as pool:
+        for item in pool.imap(_extract_pair_worker, paths, chunksize):
+            yield item
+
+
+def extract_features(paths, feature='orb', workers=None, chunksize=16, params=None):
+    """ Extract descriptors for many images with a process pool.
+        Each worker builds its detector once; results keep the order of paths.
+        workers=None uses every core, workers=1 runs in this process. """
+    paths = list(paths)
+    if workers == 1 or len(paths) < 2:
+        detector = create_detector(feature, params)
+        return [extract_feature(path, feature, detector) for path in paths]
+    with Pool(workers, initializer=_init_worker, initargs=(feature, params)) as pool:
+        return pool.map(_extract_worker, paths, chunksize)
@@ -0,0 +1,182 @@
+# pipelined sensor capture for the relocalization scripts, and a fake client for offline tests
+from __future__ import print_function
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+
+class SensorWriter(object):
+    """ Writes sensor payloads to disk from background threads so the
+        synchronous-mode client can send the next control right away.
+        The queue is bounded: when the writers fall behind, put() blocks
+        (backpressure) and the time spent blocked is recorded. """
+
+    def __init__(self, num_threads=2, max_queue=64):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.errors = []
+        self.metrics = {
+            'submitted': 0,
+            'written': 0,
+            'max_depth': 0,
+            'blocked_puts': 0,
+            'blocked_s': 0.0,
+            'write_s': 0.0,
+        }
+        self.threads = []
+        for i in range(num_threads):
+            t = threading.Thread(target=self._run, name='SensorWriter-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        self._t0 = time.time()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            measurement, filename = item
+            t0 = time.time()
+            try:
+                measurement.save_to_disk(filename)
+            except Exception as error:
+                with self.lock:
+                    self.errors.append((filename, error))
+            with self.lock:
+                self.metrics['written'] += 1
+                self.metrics['write_s'] += time.time() - t0
+            self.queue.task_done()
+
+    def put(self, measurement, filename):
+        """ Queue measurement.save_to_disk(filename). """
+        item = (measurement, filename)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            t0 = time.time()
+            self.queue.put(item)
+            with self.lock:
+                self.metrics['blocked_puts'] += 1
+                self.metrics['blocked_s'] += time.time() - t0
+        with self.lock:
+            self.metrics['submitted'] += 1
+            self.metrics['max_depth'] = max(self.metrics['max_depth'], self.queue.qsize())
+
+    def close(self):
+        """ Wait for all pending writes, stop the threads, return the metrics. """
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        elapsed = time.time() - self._t0
+        metrics = dict(self.metrics)
+        metrics['errors'] = len(self.errors)
+        metrics['elapsed_s'] = elapsed
+        metrics['writes_per_s'] = metrics['written'] / elapsed if elapsed > 0 else 0.0
+        if self.errors:
+            print('SensorWriter: %d writes failed, first: %s %r' % (len(self.errors), self.errors[0][0], self.errors[0][1]))
+        return metrics
+
+
+def print_metrics(metrics):
+    print('writer: %(written)d/%(submitted)d written, max queue depth %(max_depth)d, '
+          '%(blocked_puts)d blocked puts (%(blocked_s).2fs), %(writes_per_s).1f writes/s' % metrics)
+
+
+# ---------------------------------------------------------------------------
+# Fake client replaying recorded measurements (Trajectory.txt / Control.txt)
+# ---------------------------------------------------------------------------
+
+class _Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeSensorData(object):
+    """ Stand-in for carla.sensor.Image: save_to_disk writes a small file
+        after an optional delay that simulates encoding/disk time. """
+
+    def __init__(self, name, frame, delay=0.0, size=256):
+        self.name = name
+        self.frame = frame
+        self.delay = delay
+        self.size = size
+
+    def save_to_disk(self, filename):
+        if self.delay:
+            time.sleep(self.delay)
+        filename = filename if filename.endswith('.png') else filename + '.png'
+        folder = os.path.dirname(filename)
+        if folder and not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass  # created by another writer thread
+        with open(filename, 'wb') as f:
+            f.write(b'\0' * self.size)
+
+
+class FakeCarlaClient(object):
+    """ Replays a recorded Trajectory.txt (frame x y) and optionally a
+        Control.txt (frame steer throttle brake hand_brake reverse) with
+        the subset of the CarlaClient API used by run_carla_client. """
+
+    def __init__(self, trajectory_file, control_file=None,
+                 sensors=('RGB', 'Depth', 'SemanticSegmentation'), save_delay=0.0, step_delay=0.0):
+        with open(trajectory_file) as f:
+            self.trajectory = [line.split() for line in f if line.strip()]
+        self.controls = None
+        if control_file is not None:
+            with open(control_file) as f:
+                self.controls = [line.split() for line in f if line.strip()]
+        self.sensors = sensors
+        self.save_delay = save_delay
+        self.step_delay = step_delay
+        self.frame = 0
+        self.sent_controls = []
+
+    def load_settings(self, settings):
+        return _Obj(player_start_spots=[None] * 200)
+
+    def start_episode(self, player_start):
+        self.frame = 0
+
+    def read_data(self):
+        if self.step_delay:
+            time.sleep(self.step_delay)
+        words = self.trajectory[min(self.frame, len(self.trajectory) - 1)]
+        location = _Obj(x=float(words[1]), y=float(words[2]), z=0.0)
+        control = _Obj(steer=0.0, throttle=0.0, brake=0.0, hand_brake=False, reverse=False)
+        if self.controls is not None:
+            c = self.controls[min(self.frame, len(self.controls) - 1)]
+            control = _Obj(steer=float(c[1]), throttle=float(c[2]), brake=float(c[3]),
+                           hand_brake=(c[4] == 'True'), reverse=(c[5] == 'True'))
+        measurements = _Obj(
+            non_player_agents=[],
+            player_measurements=_Obj(transform=_Obj(location=location), autopilot_control=control))
+        sensor_data = dict((name, FakeSensorData(name, self.frame, self.save_delay)) for name in self.sensors)
+        return measurements, sensor_data
+
+    def send_control(self, *args, **kwargs):
+        self.sent_controls.append((self.frame, args, kwargs))
+        self.frame += 1
+
+
+def fake_client_factory(trajectory_file, control_file=None, **kwargs):
+    """ Drop-in for make_carla_client(host, port), e.g.
+        args.client_factory = fake_client_factory('Trajectory.txt', 'Control.txt') """
+
+    @contextmanager
+    def factory(host, port):
+        yield FakeCarlaClient(trajectory_file, control_file, **kwargs)
+    return factory
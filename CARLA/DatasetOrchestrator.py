@@ -0,0 +1,297 @@
+# generate the relocalization dataset for a matrix of conditions on several CARLA servers at once
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from carla.tcp import TCPConnectionError
+
+import RelocalizationReference as reference
+import RelocalizationQuery as query
+
+
+def folder_name(weather, player_start, vehicles, pedestrians):
+    return "W%03d_P%03d_V%03d_P%03d" % (weather, player_start, vehicles, pedestrians)
+
+
+class Job(object):
+    """ One episode to record: 'reference' drives with the autopilot under
+        the given dynamics, 'query' replays the recording in folder
+        source (of the same town directory) under its own dynamics. """
+
+    def __init__(self, kind, weather, player_start, vehicles, pedestrians, source=None):
+        self.kind = kind
+        self.weather = weather
+        self.player_start = player_start
+        self.vehicles = vehicles
+        self.pedestrians = pedestrians
+        self.source = source
+
+    @property
+    def name(self):
+        return folder_name(self.weather, self.player_start, self.vehicles, self.pedestrians)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return '%s %s' % (self.kind, self.name)
+
+
+def job_matrix(weathers, player_starts, dynamics, static=(0, 0), reference_dynamic=None, queries=True):
+    """ One reference job per (weather, start), driven under
+        reference_dynamic (default: the first of dynamics), plus query
+        jobs replaying it under the static condition and under every
+        other (vehicles, pedestrians) of dynamics, so all folders of a
+        (weather, start) share one trajectory. """
+    dynamics = [tuple(d) for d in dynamics]
+    static = tuple(static)
+    if static in dynamics:
+        raise ValueError('static condition %s is also one of the dynamics' % (static,))
+    if reference_dynamic is None:
+        if not dynamics:
+            return []
+        reference_dynamic = dynamics[0]
+    reference_dynamic = tuple(reference_dynamic)
+    if reference_dynamic not in dynamics:
+        raise ValueError('reference dynamic %s is not one of the dynamics' % (reference_dynamic,))
+    replays = [static] + [d for d in dynamics if d != reference_dynamic]
+    jobs = []
+    for weather in weathers:
+        for player_start in player_starts:
+            ref = Job('reference', weather, player_start, reference_dynamic[0], reference_dynamic[1])
+            jobs.append(ref)
+            if queries:
+                jobs += [Job('query', weather, player_start, v, p, source=ref.name) for v, p in replays]
+    return jobs
+
+
+class Orchestrator(object):
+    """ Runs jobs on N simulator endpoints, one job per endpoint at a time.
+        Every job writes into its own <out_dir>/<name>.partial directory,
+        which is renamed to <out_dir>/<name> once the episode is done, so
+        a finished folder is always complete. On a restart finished jobs
+        are skipped and leftover .partial directories are recorded again.
+        A job is retried (on any free endpoint) after TCPConnectionError;
+        any other error fails the job and the endpoint moves on. An
+        endpoint that fails endpoint_failures connections in a row is
+        given no more jobs. """
+
+    def __init__(self, out_dir, endpoints=(('localhost', 2000),), image_size=(256, 256), retries=3,
+                 retry_delay=1.0, client_factory=None, options=None, endpoint_failures=2):
+        self.out_dir = out_dir
+        self.endpoints = list(endpoints)
+        self.image_size = list(image_size)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.endpoint_failures = endpoint_failures
+        self.client_factory = client_factory  # None: make_carla_client of the scripts
+        self.options = options or {}  # extra ArgsClass attributes, e.g. {'binary_log': True}
+        self.lock = threading.Lock()
+        self.status = {}
+        self.failures = {}  # 每个端点连续的连接错误次数（跨阶段累计）
+        self.unhealthy = []  # 连续连接失败、不再使用的端点
+
+    def final_dir(self, job):
+        return os.path.join(self.out_dir, job.name)
+
+    def partial_dir(self, job):
+        return self.final_dir(job) + '.partial'
+
+    def is_done(self, job):
+        return os.path.isfile(os.path.join(self.final_dir(job), 'job.json'))
+
+    def make_args(self, job, endpoint, work_dir):
+        if job.kind == 'reference':
+            args = reference.ArgsClass(job.weather, job.player_start, self.image_size, job.vehicles, job.pedestrians)
+        else:
+            source = os.path.join(self.out_dir, job.source)
+            args = query.ArgsClass(job.weather, job.player_start, os.path.join(source, 'Control.txt'),
+                                   os.path.join(source, 'Trajectory.txt'), self.image_size,
+                                   job.vehicles, job.pedestrians)
+        for key, value in self.options.items():
+            setattr(args, key, value)
+        args.host, args.port = endpoint
+        args.client_factory = self.client_factory
+        # images go to <work_dir>/<sensor>/<frame>, episode index is not used
+        args.out_filename_format = os.path.join(work_dir.replace('{', '{{').replace('}', '}}'), '{1:s}', '{2:0>6d}')
+        args.trajectory_out = os.path.join(work_dir, 'Trajectory.txt')
+        args.control_out = os.path.join(work_dir, 'Control.txt')
+        return args
+
+    def run_job(self, job, endpoint):
+        """ Record job on endpoint; TCPConnectionError is left to the caller. """
+        work_dir = self.partial_dir(job)
+        if os.path.isdir(work_dir):
+            shutil.rmtree(work_dir)  # an interrupted attempt, the episode restarts at frame 0
+        os.makedirs(work_dir)
+        args = self.make_args(job, endpoint, work_dir)
+        module = reference if job.kind == 'reference' else query
+        t0 = time.time()
+        module.run_carla_client(args)
+        info = job.to_dict()
+        info.update(endpoint=list(endpoint), seconds=time.time() - t0)
+        with open(os.path.join(work_dir, 'job.json'), 'w') as f:
+            json.dump(info, f, indent=2)
+        final = self.final_dir(job)
+        if os.path.isdir(final):
+            shutil.rmtree(final)  # unfinished folder without job.json
+        os.rename(work_dir, final)
+
+    def _worker(self, endpoint, jobs, alive):
+        while True:
+            job = jobs.get()
+            if job is None:
+                jobs.task_done()
+                return
+            attempts = self.status[job.name]['attempts'] + 1
+            with self.lock:
+                self.status[job.name].update(attempts=attempts, state='running', endpoint=list(endpoint))
+            try:
+                self.run_job(job, endpoint)
+                state = 'done'
+                self.failures[endpoint] = 0
+            except TCPConnectionError as error:
+                logging.error('%s on %s:%s: %s', job, endpoint[0], endpoint[1], error)
+                self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+                state = 'failed' if attempts > self.retries else 'retry'
+            except Exception:
+                # 非连接错误（磁盘、回放文件等）重试无用，标记失败，继续下一个任务
+                logging.exception('%s on %s:%s failed', job, endpoint[0], endpoint[1])
+                state = 'failed'
+            with self.lock:
+                self.status[job.name]['state'] = state
+            print('%s: %s (attempt %d, %s:%s)' % (job, state, attempts, endpoint[0], endpoint[1]))
+            if state == 'retry':
+                jobs.put(job)  # 放回队列，由任一空闲端点取走
+            jobs.task_done()
+            if self.failures.get(endpoint, 0) >= self.endpoint_failures:
+                self._retire(endpoint, jobs, alive)
+                return
+            if self.failures.get(endpoint, 0):
+                time.sleep(self.retry_delay)  # 先让其他端点取走重试的任务
+
+    def _retire(self, endpoint, jobs, alive):
+        # 端点连续连接失败：不再向它派发任务；最后一个端点退出时，剩余任务全部标记失败
+        logging.error('%s:%s failed %d times in a row, no more jobs are sent to it',
+                      endpoint[0], endpoint[1], self.endpoint_failures)
+        with self.lock:
+            self.unhealthy.append(endpoint)
+            alive[0] -= 1
+            last = alive[0] == 0
+        if not last:
+            return
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                return
+            if job is not None:
+                with self.lock:
+                    self.status[job.name]['state'] = 'failed'
+            jobs.task_done()
+
+    def _run_phase(self, jobs):
+        endpoints = [endpoint for endpoint in self.endpoints if endpoint not in self.unhealthy]
+        if not endpoints:
+            for job in jobs:
+                self.status[job.name]['state'] = 'failed'
+            return
+        pending = queue.Queue()
+        for job in jobs:
+            pending.put(job)
+        alive = [len(endpoints)]
+        threads = [threading.Thread(target=self._worker, args=(endpoint, pending, alive)) for endpoint in endpoints]
+        for t in threads:
+            t.start()
+        # 重试的任务在 task_done 之前放回队列，join 返回时每个任务都已完成或失败
+        pending.join()
+        for _ in threads:
+            pending.put(None)
+        for t in threads:
+            t.join()
+
+    def run(self, jobs):
+        """ Run all jobs not finished yet, references before the queries
+            that replay them. Returns {name: status}. """
+        names = [job.name for job in jobs]
+        if len(set(names)) != len(names):
+            raise ValueError('two jobs write the same folder')
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        self.status = {}
+        self.failures = {}
+        self.unhealthy = []
+        todo = []
+        for job in jobs:
+            done = self.is_done(job)
+            self.status[job.name] = {'kind': job.kind, 'attempts': 0, 'state': 'done' if done else 'pending'}
+            if not done:
+                todo.append(job)
+        print('%d jobs, %d already done, %d endpoints' % (len(jobs), len(jobs) - len(todo), len(self.endpoints)))
+
+        self._run_phase([job for job in todo if job.kind == 'reference'])
+        queries = []
+        for job in todo:
+            if job.kind != 'query':
+                continue
+            if os.path.isfile(os.path.join(self.out_dir, job.source, 'job.json')):
+                queries.append(job)
+            else:
+                self.status[job.name]['state'] = 'skipped'  # its reference recording failed
+        self._run_phase(queries)
+        return self.status
+
+
+def parse_endpoint(text):
+    host, _, port = text.rpartition(':')
+    return (host or 'localhost', int(port))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='record the relocalization dataset on several CARLA servers')
+    parser.add_argument('--out', required=True, help='town directory, e.g. RelocalizationData/Town02')
+    parser.add_argument('--endpoint', action='append', default=None, help='host:port of a server, repeat per server')
+    parser.add_argument('--weather', type=int, nargs='+', default=[0])
+    parser.add_argument('--start', type=int, nargs='+', default=[100])
+    parser.add_argument('--dynamic', nargs='+', default=['50,200', '75,300'], help='vehicles,pedestrians')
+    parser.add_argument('--static', default='0,0', help='vehicles,pedestrians of the static query replay')
+    parser.add_argument('--reference-dynamic', default=None,
+                        help='vehicles,pedestrians of the reference drive (default: the first --dynamic), '
+                             'the other dynamics are query replays of it')
+    parser.add_argument('--no-query', action='store_true')
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--binary-log', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    endpoints = [parse_endpoint(e) for e in (args.endpoint or ['localhost:2000'])]
+    dynamics = [tuple(int(n) for n in d.split(',')) for d in args.dynamic]
+    static = tuple(int(n) for n in args.static.split(','))
+    reference_dynamic = tuple(int(n) for n in args.reference_dynamic.split(',')) if args.reference_dynamic else None
+    try:
+        jobs = job_matrix(args.weather, args.start, dynamics, static, reference_dynamic, queries=not args.no_query)
+    except ValueError as error:
+        parser.error(str(error))
+    orchestrator = Orchestrator(args.out, endpoints, retries=args.retries, options={'binary_log': args.binary_log})
+    status = orchestrator.run(jobs)
+    failed = [name for name, s in sorted(status.items()) if s['state'] != 'done']
+    if failed:
+        print('not finished:', ' '.join(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,6 +13,9 @@ from carla.settings import CarlaSettings
 from carla.tcp import TCPConnectionError
 from carla.util import print_over_same_line
 
+from CapturePipeline import SensorWriter, print_metrics
+from TrajectoryLog import ControlReplay, TrajectoryLogger, print_drift_report
+
 import numpy as np
 import os
 import shutil
@@ -29,7 +32,11 @@ def run_carla_client(args):
     # context manager, it creates a CARLA client object and starts the
     # connection. It will throw an exception if something goes wrong. The
     # context manager makes sure the connection is always cleaned up on exit.
-    with make_carla_client(args.host, args.port) as client:
+    # The recorded trajectory and control are parsed once, not on every frame.
+    replay = ControlReplay(args.trajectoryFile, args.controlFile, frames_per_episode)
+
+    client_factory = getattr(args, 'client_factory', None) or make_carla_client
+    with client_factory(args.host, args.port) as client:
         print('CarlaClient connected')
         for episode in range(0, number_of_episodes):
             # Start a new episode.
@@ -105,104 +112,82 @@ def run_carla_client(args):
             print('Starting new episode...')
             client.start_episode(player_start)
 
-            # Iterate every frame in the episode.
-            for frame in range(0, frames_per_episode):
-
-                print('Frame : ', frame)
-                save_bool = True
-
-                # Read the data produced by the server this frame.
-                measurements, sensor_data = client.read_data()
-
-                # Save Trajectory
-                save_trajectory(frame, measurements)
-
-                # Read trajectory to check if it is the same #bbescos
-                file = open(args.trajectoryFile, 'r')
-                lines = file.readlines()
-                line = lines[frame]
-                words = line.split()
-                pos_x_s = float(words[1])
-                if abs(pos_x_s - measurements.player_measurements.transform.location.x) > 0.1*5:
-                    save_bool = False
-                    print(pos_x_s, measurements.player_measurements.transform.location.x)
-                pos_y_s = float(words[2])
-                if abs(pos_y_s - measurements.player_measurements.transform.location.y) > 0.1*5:
-                    save_bool = False
-                    print(pos_y_s, measurements.player_measurements.transform.location.y)
-                file.close()
-
-                # Save the images to disk if requested.
-                if args.save_images_to_disk and frame % 10 == 0 and frame > 29 and save_bool:
-                    for name, measurement in sensor_data.items():
-                        filename = args.out_filename_format.format(episode, name, frame)
-                        measurement.save_to_disk(filename)
-
-                # Now we have to send the instructions to control the vehicle.
-                # If we are in synchronous mode the server will pause the
-                # simulation until we send this control.
-                if not args.autopilot:
-
-                    client.send_control(
-                        steer=random.uniform(-1.0, 1.0),
-                        throttle=0.5,
-                        brake=0.0,
-                        hand_brake=False,
-                        reverse=False)
-                else:
-
-                    # Together with the measurements, the server has sent the
-                    # control that the in-game autopilot would do this frame. We
-                    # can enable autopilot by sending back this control to the
-                    # server.
-                    control = measurements.player_measurements.autopilot_control
-                    # Read control file
-                    file = open(args.controlFile, 'r')
-                    lines = file.readlines()
-                    line = lines[frame]
-                    words = line.split()
-                    steer = float(words[1])
-                    throttle = float(words[2])
-                    brake = float(words[3])
-                    hand_brake = (words[4] == 'True')
-                    reverse = (words[5] == 'True')
-                    ##
-                    # steer = round(steer,10)
-                    # throttle = round(throttle, 10)
-                    # brake = round(brake, 10)
-                    ##
-                    file.close()
-                    control.steer = steer
-                    control.throttle = throttle
-                    control.brake = brake
-                    control.hand_brake = hand_brake
-                    control.reverse = reverse
-                    save_control(frame, control)
-                    client.send_control(control)
-
-
-def save_trajectory(frame, measurements):
-    number_of_agents = len(measurements.non_player_agents)
-    player_measurements = measurements.player_measurements
-
-    pos_x = player_measurements.transform.location.x
-    pos_y = player_measurements.transform.location.y
-
-    file = open("Trajectory_s.txt", "a")
-    file.write("%5i %5.1f %5.1f\n" % (frame, pos_x, pos_y))
-    file.close()
-
-
-def save_control(frame, control):
-    steer = control.steer
-    throttle = control.throttle
-    brake = control.brake
-    hand_brake = control.hand_brake
-    reverse = control.reverse
-
-    file = open("Control_s.txt", "a")
-    file.write("%5i %1.50f %2.2f %2.2f %r %r \n" % (frame, steer, throttle, brake, hand_brake, reverse))
-    file.close()
+            # In pipelined mode the images are written by background threads
+            # while the next control is already sent to the server.
+            writer = None
+            if getattr(args, 'pipelined', False):
+                writer = SensorWriter(args.writer_threads, args.writer_queue)
+            try:
+                with TrajectoryLogger(getattr(args, 'trajectory_out', "Trajectory_s.txt"), getattr(args, 'control_out', "Control_s.txt"),
+                                      getattr(args, 'log_flush_every', 100), getattr(args, 'binary_log', False)) as log:
+
+                    positions = np.zeros((frames_per_episode, 2))
+
+                    # Iterate every frame in the episode.
+                    for frame in range(0, frames_per_episode):
+
+                        print('Frame : ', frame)
+                        save_bool = True
+
+                        # Read the data produced by the server this frame.
+                        measurements, sensor_data = client.read_data()
+
+                        # Save Trajectory
+                        log.log_trajectory(frame, measurements)
+
+                        # Check the trajectory is the same as the recorded one #bbescos
+                        location = measurements.player_measurements.transform.location
+                        positions[frame] = (location.x, location.y)
+                        if not replay.on_track(frame, location.x, location.y):
+                            save_bool = False
+                            print(replay.position[frame], (location.x, location.y))
+
+                        # Save the images to disk if requested.
+                        if args.save_images_to_disk and frame % 10 == 0 and frame > 29 and save_bool:
+                            for name, measurement in sensor_data.items():
+                                filename = args.out_filename_format.format(episode, name, frame)
+                                if writer is not None:
+                                    writer.put(measurement, filename)
+                                else:
+                                    measurement.save_to_disk(filename)
+
+                        # Now we have to send the instructions to control the vehicle.
+                        # If we are in synchronous mode the server will pause the
+                        # simulation until we send this control.
+                        if not args.autopilot:
+
+                            client.send_control(
+                                steer=random.uniform(-1.0, 1.0),
+                                throttle=0.5,
+                                brake=0.0,
+                                hand_brake=False,
+                                reverse=False)
+                        else:
+
+                            # Together with the measurements, the server has sent the
+                            # control that the in-game autopilot would do this frame. We
+                            # can enable autopilot by sending back this control to the
+                            # server.
+                            control = measurements.player_measurements.autopilot_control
+                            # Recorded control of this frame
+                            steer, throttle, brake, hand_brake, reverse = replay.control(frame)
+                            ##
+                            # steer = round(steer,10)
+                            # throttle = round(throttle, 10)
+                            # brake = round(brake, 10)
+                            ##
+                            control.steer = steer
+                            control.throttle = throttle
+                            control.brake = brake
+                            control.hand_brake = hand_brake
+                            control.reverse = reverse
+                            log.log_control(frame, control)
+                            client.send_control(control)
+            finally:
+                # 出错时也等待已排队的图像写完并结束写盘线程
+                if writer is not None:
+                    print_metrics(writer.close())
+            print_drift_report(replay.drift_report(positions))
 
 
 def run_carla_client_static(args):
@@ -243,6 +228,14 @@ class ArgsClass():
         self.image_height = image_size[1]
         self.NumberOfVehicles = NumberOfVehicles
         self.NumberOfPedestrians = NumberOfPedestrians
+        self.pipelined = True  # write images in background threads
+        self.writer_threads = 2
+        self.writer_queue = 64  # max pending images before read_data blocks
+        self.client_factory = None  # None: make_carla_client, or CapturePipeline.fake_client_factory
+        self.log_flush_every = 100  # frames between flushes of the trajectory/control files
+        self.binary_log = False  # also write Trajectory/Control .npy for memory-mapped loading
+        self.trajectory_out = "Trajectory_s.txt"  # where this run logs its trajectory and control
+        self.control_out = "Control_s.txt"
 
 
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+# writing, reading (and replaying) the Trajectory.txt / Control.txt files of the relocalization scripts
+from __future__ import print_function
+
+import os
+import numpy as np
+
+# a replayed frame is kept only if the car is this close (m) to the recorded position
+DRIFT_TOLERANCE = 0.1*5
+
+
+# 二进制列式副本：Trajectory.npy (frame, x, y)，Control.npy (frame, steer, throttle, brake, hand_brake, reverse)
+TRAJECTORY_COLUMNS = ('frame', 'x', 'y')
+CONTROL_COLUMNS = ('frame', 'steer', 'throttle', 'brake', 'hand_brake', 'reverse')
+
+
+def binary_path(path):
+    return os.path.splitext(path)[0] + '.npy'
+
+
+def _fresh_binary(path):
+    # the .npy is used only if it was written after the last change of the text file
+    npy = binary_path(path)
+    if not os.path.exists(npy):
+        return None
+    if os.path.exists(path) and os.path.getmtime(npy) < os.path.getmtime(path):
+        return None
+    return npy
+
+
+def _parse_trajectory(path):
+    return np.loadtxt(path, ndmin=2)[:, :3]
+
+
+def _parse_control(path):
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            words = line.split()
+            if words:
+                rows.append((int(words[0]), float(words[1]), float(words[2]), float(words[3]),
+                             words[4] == 'True', words[5] == 'True'))
+    return np.array(rows, dtype=np.float64).reshape(-1, len(CONTROL_COLUMNS))
+
+
+def trajectory_array(path):
+    """ n x 3 (frame, x, y): memory-mapped from the .npy copy if it is up to date,
+        else parsed from the text file. """
+    npy = _fresh_binary(path)
+    return np.load(npy, mmap_mode='r') if npy else _parse_trajectory(path)
+
+
+def control_array(path):
+    """ n x 6 (frame, steer, throttle, brake, hand_brake, reverse), like trajectory_array. """
+    npy = _fresh_binary(path)
+    return np.load(npy, mmap_mode='r') if npy else _parse_control(path)
+
+
+def load_trajectory(path):
+    """ Trajectory.txt -> (frames int array, n x 2 positions). """
+    trajectory = trajectory_array(path)
+    return trajectory[:, 0].astype(np.int64), trajectory[:, 1:3]
+
+
+def load_control(path):
+    """ Control.txt -> dict of arrays frame, steer, throttle, brake, hand_brake, reverse. """
+    control = control_array(path)
+    return {
+        'frame': control[:, 0].astype(np.int64),
+        'steer': control[:, 1],
+        'throttle': control[:, 2],
+        'brake': control[:, 3],
+        'hand_brake': control[:, 4] != 0,
+        'reverse': control[:, 5] != 0,
+    }
+
+
+class TrajectoryLogger(object):
+    """ Appends the per-frame trajectory and control lines with the files
+        kept open, flushing every flush_every frames and on close().
+        With binary=True a columnar .npy copy of each file is (re)written
+        on close(), which load_trajectory / load_control memory-map. """
+
+    def __init__(self, trajectory_file='Trajectory.txt', control_file='Control.txt', flush_every=100, binary=False):
+        self.trajectory_file = trajectory_file
+        self.control_file = control_file
+        self.flush_every = flush_every
+        self.binary = binary
+        self.prior = {}
+        if binary:
+            # rows already in the text files (earlier runs append to the same files)
+            for path, parse in [(trajectory_file, trajectory_array), (control_file, control_array)]:
+                if os.path.exists(path):
+                    self.prior[path] = np.array(parse(path))
+        self.trajectory_rows = []
+        self.control_rows = []
+        self.files = {
+            trajectory_file: open(trajectory_file, 'a'),
+            control_file: open(control_file, 'a'),
+        }
+        self.pending = 0
+
+    def log_trajectory(self, frame, measurements):
+        location = measurements.player_measurements.transform.location
+        self.files[self.trajectory_file].write("%5i %5.1f %5.1f\n" % (frame, location.x, location.y))
+        if self.binary:
+            self.trajectory_rows.append((frame, location.x, location.y))
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def log_control(self, frame, control):
+        # %.17g keeps every digit of the float (%1.50f only padded it with noise)
+        self.files[self.control_file].write("%5i %.17g %2.2f %2.2f %r %r \n" % (
+            frame, control.steer, control.throttle, control.brake, control.hand_brake, control.reverse))
+        if self.binary:
+            self.control_rows.append((frame, control.steer, control.throttle, control.brake,
+                                      control.hand_brake, control.reverse))
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+        self.pending = 0
+
+    def close(self):
+        if not self.files:
+            return
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        if self.binary:
+            for path, rows, ncols in [(self.trajectory_file, self.trajectory_rows, len(TRAJECTORY_COLUMNS)),
+                                      (self.control_file, self.control_rows, len(CONTROL_COLUMNS))]:
+                rows = np.array(rows, dtype=np.float64).reshape(-1, ncols)
+                if path in self.prior:
+                    rows = np.vstack([self.prior[path], rows])
+                np.save(binary_path(path), rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ControlReplay(object):
+    """ A recorded episode parsed once into arrays, giving O(1) access to
+        the recorded position and control of every frame. """
+
+    def __init__(self, trajectory_file, control_file, frames_per_episode=None):
+        frame, position = load_trajectory(trajectory_file)
+        control = load_control(control_file)
+        n = min(len(frame), len(control['frame']))
+        if frames_per_episode is not None:
+            if n < frames_per_episode:
+                raise ValueError('episode needs %d frames, recording has %d trajectory and %d control lines'
+                                 % (frames_per_episode, len(frame), len(control['frame'])))
+            # lines past the episode (e.g. a second recording appended) are never replayed
+            n = frames_per_episode
+        elif len(frame) != len(control['frame']):
+            raise ValueError('trajectory has %d frames but control has %d' % (len(frame), len(control['frame'])))
+        self.frame = frame[:n]
+        self.position = position[:n]
+        self.steer = control['steer'][:n]
+        self.throttle = control['throttle'][:n]
+        self.brake = control['brake'][:n]
+        self.hand_brake = control['hand_brake'][:n]
+        self.reverse = control['reverse'][:n]
+        self.validate(control['frame'][:n])
+
+    def validate(self, control_frame):
+        """ Both files must hold frames 0, 1, 2, ... in order, one line each. """
+        for name, frames in [('trajectory', self.frame), ('control', control_frame)]:
+            bad = np.nonzero(frames != np.arange(len(frames)))[0]
+            if len(bad):
+                raise ValueError('%s file: line %d holds frame %d' % (name, bad[0], frames[bad[0]]))
+
+    def __len__(self):
+        return len(self.frame)
+
+    def control(self, frame):
+        """ (steer, throttle, brake, hand_brake, reverse) recorded at frame. """
+        return (float(self.steer[frame]), float(self.throttle[frame]), float(self.brake[frame]),
+                bool(self.hand_brake[frame]), bool(self.reverse[frame]))
+
+    def on_track(self, frame, x, y, tolerance=DRIFT_TOLERANCE):
+        """ True if (x, y) is within tolerance of the recorded position on both axes. """
+        return bool(np.all(np.abs(self.position[frame] - (x, y)) <= tolerance))
+
+    def drift_report(self, positions, tolerance=DRIFT_TOLERANCE):
+        """ Compare the replayed positions (n x 2, frames 0..n-1) with the
+            recording in one pass. """
+        positions = np.asarray(positions, dtype=np.float64)
+        drift = np.abs(positions - self.position[:len(positions)])
+        off = np.nonzero((drift > tolerance).any(axis=1))[0]
+        return {
+            'frames': len(positions),
+            'off_track': len(off),
+            'off_track_frames': off,
+            'first_off_track': int(off[0]) if len(off) else None,
+            'max_drift': float(drift.max()) if len(drift) else 0.0,
+            'mean_drift': float(drift.mean()) if len(drift) else 0.0,
+        }
+
+
+def print_drift_report(report):
+    print('replay drift: %(off_track)d/%(frames)d frames off track, first %(first_off_track)s, '
+          'max %(max_drift).3f m, mean %(mean_drift).3f m' % report)
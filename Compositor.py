@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import cv2
+
+
+# CARLA 0.8 语义分割图：类别编号存在 R 通道（cv2 读入为 BGR，即第 2 通道）
+PEDESTRIANS = 4
+VEHICLES = 10
+
+
+def mask_lut(classes=(PEDESTRIANS, VEHICLES)):
+    """ 256-entry table: 255 for the dynamic classes, 0 otherwise. """
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[list(classes)] = 255
+    return lut
+
+
+MASK_LUT = mask_lut()
+
+
+def dynamic_mask(img_C, lut=MASK_LUT):
+    """ 3-channel 0/255 mask of pedestrians and vehicles from a BGR segmentation image. """
+    mask = lut[img_C[:, :, 2]]
+    return np.repeat(mask[:, :, None], 3, axis=2)
+
+
+def up_to_date(output, inputs):
+    # 输出存在且不比任何输入旧
+    if not os.path.exists(output):
+        return False
+    mtime = os.path.getmtime(output)
+    return all(os.path.getmtime(path) <= mtime for path in inputs)
+
+
+def plan(dynamic_dir, static_dir, modes=('AB', 'ABC'), force=False):
+    """ Tasks (name, A, B, C, AB output, ABC output) for every frame of
+        dynamic_dir/RGB that still needs an output; outputs already newer
+        than their inputs are left out unless force.
+        Returns (tasks, number up to date, number missing an input). """
+    A_dir = os.path.join(dynamic_dir, 'RGB')
+    B_dir = os.path.join(static_dir, 'RGB')
+    C_dir = os.path.join(dynamic_dir, 'SemanticSegmentation')
+    B_names = set(os.listdir(B_dir))
+    C_names = set(os.listdir(C_dir)) if 'ABC' in modes else set()
+    out_dirs = {}
+    for mode in modes:
+        out_dirs[mode] = os.path.join(dynamic_dir, mode)
+        if not os.path.isdir(out_dirs[mode]):
+            os.makedirs(out_dirs[mode])
+
+    tasks, nbr_done, nbr_missing = [], 0, 0
+    for name in sorted(os.listdir(A_dir)):
+        if name not in B_names or ('ABC' in modes and name not in C_names):
+            nbr_missing += 1  # 静态场景中没有这一帧
+            continue
+        A, B = os.path.join(A_dir, name), os.path.join(B_dir, name)
+        C = os.path.join(C_dir, name) if 'ABC' in modes else None
+        AB = os.path.join(out_dirs['AB'], name) if 'AB' in modes else None
+        ABC = os.path.join(out_dirs['ABC'], name) if 'ABC' in modes else None
+        if not force:
+            if AB is not None and up_to_date(AB, [A, B]):
+                AB = None
+            if ABC is not None and up_to_date(ABC, [A, B, C]):
+                ABC = None
+        if AB is None and ABC is None:
+            nbr_done += 1
+            continue
+        tasks.append((name, A, B, C if ABC is not None else None, AB, ABC))
+    return tasks, nbr_done, nbr_missing
+
+
+def compose_frame(task):
+    """ Decode A, B (and C) once and write [A B] and/or [A B mask]. """
+    name, A, B, C, AB, ABC = task
+    img_A = cv2.imread(A, cv2.IMREAD_COLOR)
+    img_B = cv2.imread(B, cv2.IMREAD_COLOR)
+    if img_A is None or img_B is None:
+        return name, False
+    if AB is not None:
+        cv2.imwrite(AB, np.concatenate([img_A, img_B], 1))  # 横向拼接
+    if ABC is not None:
+        img_C = cv2.imread(C, cv2.IMREAD_COLOR)
+        if img_C is None:
+            return name, False
+        cv2.imwrite(ABC, np.concatenate([img_A, img_B, dynamic_mask(img_C)], 1))
+    return name, True
+
+
+def compose(dynamic_dir, static_dir, modes=('AB', 'ABC'), workers=None, chunksize=8, force=False, verbose=True):
+    """ Compose the Dynamic2static inputs of one condition folder with a
+        process pool (workers=None: every core, 1: in this process). """
+    t0 = time.time()
+    tasks, nbr_done, nbr_missing = plan(dynamic_dir, static_dir, modes, force)
+    failed = []
+    pool = None
+    if workers == 1 or len(tasks) < 2:
+        results = map(compose_frame, tasks)
+    else:
+        pool = Pool(workers)
+        results = pool.imap_unordered(compose_frame, tasks, chunksize)
+    try:
+        for i, (name, ok) in enumerate(results):
+            if not ok:
+                failed.append(name)
+            if verbose and i % 200 == 0:
+                print(os.path.basename(dynamic_dir), ' process: ', i, '/', len(tasks))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - t0
+    stats = {
+        'folder': dynamic_dir,
+        'composed': len(tasks) - len(failed),
+        'up_to_date': nbr_done,
+        'missing_static': nbr_missing,
+        'failed': failed,
+        'seconds': elapsed,
+        'fps': (len(tasks) - len(failed)) / elapsed if elapsed > 0 else 0.0,
+    }
+    if verbose:
+        print('%(folder)s: %(composed)d composed, %(up_to_date)d up to date, %(missing_static)d without static frame, '
+              '%(seconds).2fs (%(fps).1f frames/s)' % stats)
+        if failed:
+            print('unreadable frames:', ' '.join(failed))
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='compose [A B] / [A B C] inputs of the Dynamic2static model')
+    parser.add_argument('--static', required=True, help='static condition folder, e.g. Town02/W000_P100_V000_P000')
+    parser.add_argument('--dynamic', nargs='+', required=True, help='dynamic condition folders')
+    parser.add_argument('--modes', nargs='+', default=['AB', 'ABC'], choices=['AB', 'ABC'])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='rewrite outputs that are up to date')
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for dynamic_dir in args.dynamic:
+        failed += len(compose(dynamic_dir, args.static, args.modes, args.workers, force=args.force)['failed'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def frame_name(path):
+    # 'xxx/RGB/000030.png' -> '000030.png'，不同动态设置下同一帧的文件名相同
+    return path[-10:]
+
+
+class FrameIndex():
+    """ Positions of the reference frames as an n x 2 array, with a dict
+        from frame name to row, and a KD-tree over the positions. """
+
+    def __init__(self, frame_img, frame_pos):
+        self.names = [frame_name(name) for name in frame_img]
+        self.positions = np.asarray(frame_pos, dtype=np.float64).reshape(-1, 2)
+        self.row_of = dict((name, i) for i, name in enumerate(self.names))
+        self._tree = None
+
+    @classmethod
+    def from_manifest(cls, manifest, conditions=None):
+        """ Frames of a FrameManifest (those common to conditions, default
+            all) that have a pose. """
+        rows = manifest.common(conditions) if conditions else np.arange(len(manifest.frames))
+        rows = rows[~np.isnan(manifest.positions[rows, 0])]
+        return cls(manifest.frame_names(rows), manifest.positions[rows])
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self.positions)
+        return self._tree
+
+    def rows(self, paths):
+        """ Row of every path (-1 if the frame is unknown). """
+        return np.array([self.row_of.get(frame_name(path), -1) for path in paths], dtype=np.int64)
+
+    def positions_of(self, rows):
+        """ Positions for an int array of rows, NaN where the row is -1. """
+        rows = np.asarray(rows)
+        pos = self.positions[np.where(rows < 0, 0, rows)]
+        pos[rows < 0] = np.nan
+        return pos
+
+
+def error_rates(pred_pos, query_pos, weight=1.0, eps=1e-3):
+    """ Relative position error per query, weight * (|dx / x| + |dy / y|);
+        1 where there is no prediction (NaN). ImageRetrieval.py uses
+        weight 1.0, get_precision.ipynb 0.5. """
+    err = weight * np.abs((pred_pos - query_pos) / (query_pos + eps)).sum(axis=1)
+    err[np.isnan(err)] = 1
+    return err
+
+
+def accuracy_at(errors, thresholds):
+    """ Fraction of errors < threshold, for all thresholds in one pass. """
+    errors = np.sort(np.asarray(errors))
+    if not len(errors):
+        return np.zeros(len(thresholds))
+    return np.searchsorted(errors, thresholds, side='left') / float(len(errors))
+
+
+def recall_at_k(index, retrieved_rows, query_pos, radii, ks):
+    """ Metric recall@k: a query is a hit at (r, k) if one of its first k
+        results lies within r meters of it. Queries with no reference
+        frame within r (looked up in the KD-tree) are left out.
+        retrieved_rows is n x max(ks), -1 padded. Returns {r: {k: recall}}. """
+    retrieved = index.positions_of(retrieved_rows)  # n x K x 2
+    dist = np.sqrt(((retrieved - query_pos[:, None, :]) ** 2).sum(axis=2))
+    dist[np.isnan(dist)] = np.inf
+    # 前 k 个结果中的最小距离
+    best = np.minimum.accumulate(dist, axis=1) if dist.shape[1] else np.full((len(dist), 1), np.inf)
+    nearest, _ = index.tree.query(query_pos, k=1)
+    recall = {}
+    for r in radii:
+        valid = nearest <= r
+        nbr_valid = int(valid.sum())
+        recall[r] = {}
+        for k in ks:
+            col = best[:, min(k, best.shape[1]) - 1]
+            recall[r][k] = float((col[valid] <= r).sum()) / nbr_valid if nbr_valid else 0.0
+    return recall
+
+
+def evaluate(index, query_paths, results, thresholds=(0.01, 0.05), radii=(1.0, 5.0, 10.0), ks=(1, 5),
+             weight=1.0):
+    """ Score image_query_batch results ([index, path, score] lists, one
+        per query path) against the reference positions of index. """
+    t0 = time.time()
+    query_pos = index.positions_of(index.rows(query_paths))
+    K = max(ks)
+    retrieved_rows = np.full((len(results), K), -1, dtype=np.int64)
+    for i, res in enumerate(results):
+        rows = index.rows([w[1] for w in res[:K]])
+        retrieved_rows[i, :len(rows)] = rows
+    known = ~np.isnan(query_pos[:, 0])
+    errors = error_rates(index.positions_of(retrieved_rows[:, 0]), query_pos, weight)[known]
+    report = {
+        'queries': int(known.sum()),
+        'unknown_queries': int((~known).sum()),
+        'no_match': int((retrieved_rows[known, 0] < 0).sum()),
+        'mean_error': float(errors.mean()) if len(errors) else 0.0,
+        'accuracy': dict(zip(thresholds, accuracy_at(errors, thresholds).tolist())),
+        'recall': recall_at_k(index, retrieved_rows[known], query_pos[known], radii, ks),
+        'errors': errors,
+    }
+    report['seconds'] = time.time() - t0
+    return report
+
+
+def print_report(report):
+    print('mean_error', report['mean_error'], 'queries', report['queries'], 'no matched', report['no_match'])
+    for thr, acc in sorted(report['accuracy'].items()):
+        print('acc (%g)' % thr, acc)
+    for r, by_k in sorted(report['recall'].items()):
+        print('recall within %gm:' % r, ', '.join('@%d %.4f' % (k, v) for k, v in sorted(by_k.items())))
@@ -0,0 +1,174 @@
+import os
+import re
+import sys
+import argparse
+import numpy as np
+from CARLA.TrajectoryLog import load_trajectory
+
+
+# 动态设置文件夹名：天气、起点、车辆数、行人数
+CONDITION_PATTERN = re.compile(r'^W\d{3}_P\d{3}_V\d{3}_P\d{3}$')
+
+
+def frame_number(name):
+    # '000030.png' -> 30
+    return int(name[-10:-4])
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return -1
+
+
+class FrameManifest():
+    """ One table over every condition folder of a town: frame id, a
+        bitmask of the conditions whose image folder has the frame (bit i
+        for conditions[i]) and the pose (x, y) from the trajectory. The
+        folders are only scanned (set joins, nothing is deleted) when one
+        of their mtimes changed; otherwise the table is read from
+        <town_dir>/.manifest/<image_dir>.npz. """
+
+    def __init__(self, town_dir, image_dir='RGB', pose_from=None):
+        self.town_dir = town_dir
+        self.image_dir = image_dir
+        self.pose_from = pose_from  # 轨迹来源的设置文件夹，None 为帧最多且有轨迹的那个
+        # 放在子目录里，写缓存不会改变 town_dir 的 mtime
+        self.path = os.path.join(town_dir, '.manifest', '%s.npz' % image_dir)
+        self.conditions = []
+        self.frames = np.zeros(0, dtype=np.int32)
+        self.available = np.zeros(0, dtype=np.uint32)
+        self.positions = np.zeros((0, 2), dtype=np.float64)
+        self.row_of = {}
+
+    @classmethod
+    def load(cls, town_dir, image_dir='RGB', pose_from=None, verbose=False):
+        """ Cached manifest, rebuilt only if a scanned directory changed. """
+        manifest = cls(town_dir, image_dir, pose_from)
+        if not manifest._read_cache():
+            manifest.build()
+            manifest.save()
+            if verbose:
+                print('manifest rebuilt:', len(manifest.frames), 'frames,', len(manifest.conditions), 'conditions')
+        manifest.row_of = dict((int(f), i) for i, f in enumerate(manifest.frames))
+        return manifest
+
+    def _watched(self, conditions):
+        # 目录增删文件会改变其 mtime；轨迹文件单独记录
+        paths = [self.town_dir]
+        for condition in conditions:
+            folder = os.path.join(self.town_dir, condition)
+            paths += [os.path.join(folder, self.image_dir), os.path.join(folder, 'Trajectory.txt'),
+                      os.path.join(folder, 'Trajectory.npy')]
+        return paths
+
+    def _read_cache(self):
+        if not os.path.exists(self.path):
+            return False
+        with np.load(self.path, allow_pickle=False) as cache:
+            conditions = [str(c) for c in cache['conditions']]
+            if str(cache['pose_from']) != (self.pose_from or ''):
+                return False
+            stamps = [_mtime(path) for path in self._watched(conditions)]
+            if not np.array_equal(stamps, cache['stamps']):
+                return False
+            self.conditions = conditions
+            self.frames = cache['frames']
+            self.available = cache['available']
+            self.positions = cache['positions']
+        return True
+
+    def build(self):
+        """ Scan every condition folder once and join the frame sets. """
+        self.conditions = sorted(name for name in os.listdir(self.town_dir)
+                                 if CONDITION_PATTERN.match(name)
+                                 and os.path.isdir(os.path.join(self.town_dir, name, self.image_dir)))
+        if len(self.conditions) > 32:
+            raise ValueError('at most 32 conditions fit the availability mask, found %d' % len(self.conditions))
+        # 每个设置的帧集合，一次 listdir
+        frame_sets = []
+        for condition in self.conditions:
+            names = os.listdir(os.path.join(self.town_dir, condition, self.image_dir))
+            frame_sets.append(set(frame_number(name) for name in names if name.endswith('.png')))
+        self.frames = np.array(sorted(set().union(*frame_sets)), dtype=np.int32)
+        row_of = dict((int(f), i) for i, f in enumerate(self.frames))
+        self.available = np.zeros(len(self.frames), dtype=np.uint32)
+        for bit, frames in enumerate(frame_sets):
+            rows = np.fromiter((row_of[f] for f in frames), dtype=np.int64, count=len(frames))
+            self.available[rows] |= np.uint32(1 << bit)
+
+        self.positions = np.full((len(self.frames), 2), np.nan, dtype=np.float64)
+        source = self._pose_source(frame_sets)
+        traj_frames = []
+        if source is not None:
+            traj_frames, traj_pos = load_trajectory(os.path.join(self.town_dir, source, 'Trajectory.txt'))
+        if len(traj_frames):
+            # 轨迹中 frame 号到行的映射：按帧号查找而不是假设行号等于帧号
+            order = np.argsort(traj_frames)
+            idx = np.searchsorted(traj_frames[order], self.frames)
+            idx[idx >= len(order)] = 0
+            found = traj_frames[order][idx] == self.frames
+            self.positions[found] = traj_pos[order[idx[found]]]
+        return self
+
+    def _pose_source(self, frame_sets):
+        if self.pose_from is not None:
+            return self.pose_from
+        with_trajectory = [(len(frames), condition) for condition, frames in zip(self.conditions, frame_sets)
+                           if os.path.exists(os.path.join(self.town_dir, condition, 'Trajectory.txt'))]
+        return max(with_trajectory)[1] if with_trajectory else None  # frame 最多
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        np.savez(self.path,
+                 conditions=np.array(self.conditions, dtype=str),
+                 pose_from=np.array(self.pose_from or ''),
+                 stamps=np.array([_mtime(path) for path in self._watched(self.conditions)], dtype=np.int64),
+                 frames=self.frames, available=self.available, positions=self.positions)
+
+    def mask(self, conditions):
+        """ Bitmask of the given condition names. """
+        bits = 0
+        for condition in conditions:
+            bits |= 1 << self.conditions.index(condition)
+        return np.uint32(bits)
+
+    def common(self, conditions):
+        """ Rows of the frames present in every one of conditions. """
+        m = self.mask(conditions)
+        return np.nonzero((self.available & m) == m)[0]
+
+    def frame_names(self, rows):
+        return ['%06d.png' % f for f in self.frames[rows]]
+
+    def frame_info(self, conditions):
+        """ (frame_img, frame_pos) of the frames common to conditions,
+            as get_frame_info used to return. """
+        rows = self.common(conditions)
+        return self.frame_names(rows), list(self.positions[rows])
+
+    def paths(self, condition, rows=None, image_dir=None):
+        """ Image paths of condition for rows (default: all its frames). """
+        if rows is None:
+            rows = self.common([condition])
+        folder = os.path.join(self.town_dir, condition, image_dir or self.image_dir)
+        return [os.path.join(folder, name) for name in self.frame_names(rows)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='frame manifest of the condition folders of a town')
+    parser.add_argument('town_dir')
+    parser.add_argument('--image-dir', default='RGB')
+    parser.add_argument('--pose-from', default=None)
+    args = parser.parse_args(argv)
+
+    manifest = FrameManifest.load(args.town_dir, args.image_dir, args.pose_from, verbose=True)
+    for bit, condition in enumerate(manifest.conditions):
+        print(condition, int(((manifest.available >> np.uint32(bit)) & np.uint32(1)).sum()), 'frames')
+    print('in every condition:', len(manifest.common(manifest.conditions)), 'of', len(manifest.frames))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,16 @@
 import os
+import time
 import pickle
 import numpy as np
 from sqlite3 import dbapi2 as sqlite
 import cv2
-from BOW.imagesearch.vocabulary import Vocabulary, extract_feature
+from BOW.imagesearch.vocabulary import Vocabulary, extract_feature, iter_features
+from BOW.imagesearch.descriptorcache import DescriptorCache
 from BOW.imagesearch import imagesearch
+from BOW.imagesearch.ann import IVFIndex
+import Evaluation
+from FrameManifest import FrameManifest
+from IngestProcessed import ingest
 
 
 def get_img_paths(training_path):
@@ -16,9 +22,133 @@ def get_img_paths(training_path):
         img_paths.append(img_path)
     return img_paths
 
+class RetrievalSession():
+    """ Long-lived retrieval state: the vocabulary (with its idf) and the
+        in-memory index are loaded once and reused across queries. They
+        are reloaded only when vocabulary.pkl or the database change on
+        disk. timings/counts record where load and query time goes.
+        ann_options (e.g. {'nlist': 64, 'nprobe': 4}) switches query()
+        to the approximate IVFIndex, query_batch() stays exact. """
+
+    STAGES = ('load_vocabulary', 'load_index', 'build_ann', 'extract', 'project', 'query')
+
+    def __init__(self, vocabulary_path, database_name, feature='orb', cache=None, ann_options=None, workers=None):
+        self.vocabulary_path = vocabulary_path
+        self.database_name = database_name
+        self.feature = feature
+        self.cache = cache
+        self.ann_options = ann_options
+        self.workers = workers  # 批量查询时提取特征的进程数
+        self.voc = None
+        self.src = None
+        self.ann = None
+        self._voc_stamp = None
+        self._db_stamp = None
+        self.timings = dict((stage, 0.0) for stage in self.STAGES)
+        self.counts = dict((stage, 0) for stage in self.STAGES)
+
+    def _tick(self, stage, t0):
+        self.timings[stage] += time.perf_counter() - t0
+        self.counts[stage] += 1
+
+    def _stamp(self, path):
+        # sqlite in WAL mode writes to db-wal before the db file itself
+        stamp = []
+        for p in [path, path + '-wal']:
+            if os.path.exists(p):
+                st = os.stat(p)
+                stamp.append((st.st_mtime_ns, st.st_size))
+        return tuple(stamp)
+
+    def vocabulary(self):
+        # 载入词汇（文件未变化时直接复用）
+        stamp = self._stamp(self.vocabulary_path)
+        if self.voc is None or stamp != self._voc_stamp:
+            t0 = time.perf_counter()
+            with open(self.vocabulary_path, 'rb') as f:
+                self.voc = pickle.load(f)
+            self._voc_stamp = stamp
+            self.src = None  # idf changed, the index norms must be rebuilt
+            self._tick('load_vocabulary', t0)
+        return self.voc
+
+    def searcher(self):
+        voc = self.vocabulary()
+        stamp = self._stamp(self.database_name)
+        if self.src is None or stamp != self._db_stamp:
+            t0 = time.perf_counter()
+            self.src = imagesearch.SparseSearcher(self.database_name, voc)
+            self._db_stamp = stamp
+            self._tick('load_index', t0)
+            if self.ann_options is not None:
+                t0 = time.perf_counter()
+                self.ann = IVFIndex(self.src, **self.ann_options)
+                self._tick('build_ann', t0)
+        return self.src
+
+    def histogram(self, path):
+        # 已入库的图像直接取直方图，否则提取特征并投影到词汇上
+        if path in self.src.row_of:
+            return self.src.get_imhistogram(path)
+        t0 = time.perf_counter()
+        if self.cache is not None:
+            des = self.cache.get([path])[0]
+        else:
+            des = extract_feature(path, self.feature)
+        self._tick('extract', t0)
+        t0 = time.perf_counter()
+        h = self.voc.project(des)
+        self._tick('project', t0)
+        return h
+
+    def histograms(self, paths):
+        # 同 histogram，但未入库的图像一次性并行提取（一次 cache.get）
+        hists = [self.src.get_imhistogram(path) if path in self.src.row_of else None for path in paths]
+        missing = [path for path, h in zip(paths, hists) if h is None]
+        if len(missing) and self.cache is None:
+            return [h if h is not None else self.histogram(path) for path, h in zip(paths, hists)]
+        if len(missing):
+            t0 = time.perf_counter()
+            des_list = self.cache.get(missing, workers=self.workers)
+            self._tick('extract', t0)
+            t0 = time.perf_counter()
+            projected = iter([self.voc.project(des) for des in des_list])
+            self._tick('project', t0)
+            hists = [h if h is not None else next(projected) for h in hists]
+        return hists
+
+    def query(self, path, nbr_results=None):
+        self.searcher()
+        h = self.histogram(path)
+        t0 = time.perf_counter()
+        if self.ann is not None:
+            res = self.ann.query_histogram(h, k=nbr_results)
+        else:
+            res = self.src.query_histogram(h)
+        self._tick('query', t0)
+        return res
+
+    def query_batch(self, paths, k=5, restrict_to=None):
+        self.searcher()
+        hists = self.histograms(list(paths))
+        t0 = time.perf_counter()
+        res = self.src.query_batch(hists, k=k, restrict_to=restrict_to)
+        self._tick('query', t0)
+        return res
+
+    def stats(self):
+        """ Total seconds, call count and mean milliseconds per stage. """
+        return dict((stage, {'total_s': self.timings[stage],
+                             'count': self.counts[stage],
+                             'mean_ms': 1000.0*self.timings[stage]/max(self.counts[stage], 1)})
+                    for stage in self.STAGES)
+
+
 class ImageRetrieval():
-    def __init__(self):
+    def __init__(self, retrain=False):
+        # retrain: 重新训练词汇；否则已有 vocabulary.pkl 时直接复用
         self.feature = 'orb'
+        self.workers = None  # 特征提取进程数，None 为全部核心
         self.base_dir = 'D:\\MyFiles\\SceneTransformation\\Relocalization_all\\Town02\\W000_P100_V000_P000'
         self.training_path = os.path.join(self.base_dir, 'RGB')  # 训练样本文件夹路径
 
@@ -31,12 +161,19 @@ class ImageRetrieval():
                              get_img_paths(os.path.join('D:\\MyFiles\\SceneTransformation\\Relocalization_all\\Town02\\W000_P100_V050_P200', 'RGB')) + \
                              get_img_paths(os.path.join('D:\\MyFiles\\SceneTransformation\\Relocalization_all\\Town02\\W000_P100_V075_P300', 'RGB'))
 
-        self.gen_vocabulary(word_num=1000)
+        # 特征缓存（按路径与修改时间），训练词汇、建库与查询共用
+        self.cache = DescriptorCache(os.path.join(self.base_dir, 'descriptors'), self.feature)
+        # 近似检索（IVF），None 为精确检索，如 {'nlist': 64, 'nprobe': 4}
+        self.ann_options = None
+        self.session = RetrievalSession(self.vocabulary_path, self.database_name, self.feature, self.cache,
+                                        self.ann_options, self.workers)
+        if retrain or not os.path.exists(self.vocabulary_path):
+            self.gen_vocabulary(word_num=1000)
 
     def gen_vocabulary(self, word_num=100, subsampling=10):
         # subsampling: 训练数据的下采样（subsampling）可用于加速
         voc = Vocabulary(self.vocabulary_name, self.feature)
-        voc.train(self.img_paths, word_num, subsampling)
+        voc.train(self.img_paths, word_num, subsampling, workers=self.workers, cache=self.cache)
         # 保存词汇
         with open(self.vocabulary_path, 'wb') as f:
             pickle.dump(voc, f)
@@ -44,31 +181,82 @@ class ImageRetrieval():
 
     def commit_database(self):
         # 载入词汇
-        with open(self.vocabulary_path, 'rb') as f:
-            voc = pickle.load(f)
+        voc = self.session.vocabulary()
 
         # 创建索引
         indx = imagesearch.Indexer(self.database_name, voc)
         indx.create_tables()
-        # 遍历所有的图像，并将它们的特征投影到词汇上
-        for path in self.all_img_paths:
-            des = extract_feature(path, self.feature)
-            indx.add_to_index(path, des)
-        # 提交到数据库
-        indx.db_commit()
+        # 遍历所有的图像，并将它们的特征投影到词汇上，一个事务内批量写入数据库
+        des_list = self.cache.get(self.all_img_paths, workers=self.workers)
+        items = zip(self.all_img_paths, des_list)
+        df = np.zeros(voc.nbr_words, dtype=np.int64)
+        nbr_added, rate = indx.add_batch(items, df=df)
+        del indx
+        # idf 统一按库中全部图像计算，与 add_folders/add_processed 增量累加的结果一致
+        self._update_idf(voc, df, nbr_added, reset=True)
+
+    def add_folders(self, folders, retrain=False):
+        # 增量加入新的动态设置文件夹（如 W000_P100_V050_P200）：不重建数据库，不重新训练词汇，
+        # 只为新图像提取特征、入库，并就地更新文档频数与 idf
+        new_paths = []
+        for folder in folders:
+            new_paths += get_img_paths(os.path.join(folder, 'RGB'))
+        if retrain:
+            self.all_img_paths += [path for path in new_paths if path not in set(self.all_img_paths)]
+            self.gen_vocabulary(word_num=1000)
+            self.commit_database()
+            return len(new_paths)
+
+        voc = self.session.vocabulary()
+        indx = imagesearch.Indexer(self.database_name, voc)
+        indx.create_tables(drop=False)
+        indexed = indx.indexed_names()
+        new_paths = [path for path in new_paths if path not in indexed]
+
+        des_list = self.cache.get(new_paths, workers=self.workers)
+        df = np.zeros(voc.nbr_words, dtype=np.int64)
+        nbr_added, rate = indx.add_batch(zip(new_paths, des_list), df=df)
+        del indx
+        self._update_idf(voc, df, nbr_added)
+        self.all_img_paths += new_paths
+        return nbr_added
+
+    def add_processed(self, images_dir, dest_dir, mode='link', chunk_size=64):
+        # Dynamic2static 推理结果：fake_B 边整理（硬链接/重命名为 xxxxxx.png）边提取特征、入库，
+        # 每 chunk_size 幅提交一次，整理尚未结束时已入库的图像就可以检索
+        voc = self.session.vocabulary()
+        indx = imagesearch.Indexer(self.database_name, voc)
+        indx.create_tables(drop=False)
+        indexed = indx.indexed_names()
+        new_paths = []
+
+        def arriving():
+            for path in ingest(images_dir, dest_dir, mode):
+                if path not in indexed:
+                    new_paths.append(path)
+                    yield path
+
+        items = self.cache.put_stream(iter_features(arriving(), self.feature, self.workers), chunk_size)
+        df = np.zeros(voc.nbr_words, dtype=np.int64)
+        nbr_added, rate = indx.add_batch(items, chunk_size=chunk_size, df=df, commit_chunks=True)
+        del indx
+        self._update_idf(voc, df, nbr_added)
+        self.all_img_paths += new_paths
+        return nbr_added
+
+    def _update_idf(self, voc, df, nbr_added, reset=False):
+        # 就地更新文档频数与 idf，词汇本身不变；reset 时以库中图像的文档频数替换训练集的
+        if nbr_added:
+            voc.update_idf(df, nbr_added, reset)
+            with open(self.vocabulary_path, 'wb') as f:
+                pickle.dump(voc, f)
+        print('added', nbr_added, 'images, vocabulary images:', voc.nbr_images)
 
     def image_query(self, query_image_path, nbr_results=5, show_plot=False, src_return=False):
         # nbr_results 结果图像数
-        # 载入词汇
-        with open(self.vocabulary_path, 'rb') as f:
-            voc = pickle.load(f)
-        src = imagesearch.Searcher(self.database_name, voc)
-        # 遍历所有的图像，并将它们的特征投影到词汇上
-        # iw = voc.project(descr)
-        # print('当前图像单词词频（直方图）：'), print(iw)
-        # print('候选图像列表：'), print(src.candidates_from_histogram(iw)[:10])  # 获取具有相似单词的图像列表
-        # print('匹配结果：')
-        res_info = src.query(query_image_path)[:nbr_results]  # ((distance, id),())
+        # 词汇与索引由 session 缓存，只在文件变化时重新载入
+        res_info = self.session.query(query_image_path, nbr_results)[:nbr_results]  # ((distance, id),())
+        src = self.session.src
         res_id = [w[1] for w in res_info]
         if show_plot:
             imagesearch.plot_results(src, res_id)
@@ -76,7 +264,7 @@ class ImageRetrieval():
         res = []
         for item in res_info:
             index = item[1]-1
-            path = self.all_img_paths[index]
+            path = src.get_filename(item[1])  # 文件名取自索引本身，包括之前增量入库的图像
             score = item[0]
             tmp = [index, path, score]
             res.append(tmp)
@@ -85,32 +273,26 @@ class ImageRetrieval():
         else:
             return res
 
+    def image_query_batch(self, query_image_paths, k=5, restrict_to=None):
+        # 一次性检索所有查询图像，restrict_to 为参考文件夹名（如 'W000_P100_V000_P000'）
+        res_info = self.session.query_batch(query_image_paths, k=k, restrict_to=restrict_to)  # [((distance, id),()), ...]
+        src = self.session.src
+
+        res = []
+        for items in res_info:
+            tmp = []
+            for item in items:
+                index = item[1]-1
+                tmp.append([index, src.get_filename(item[1]), item[0]])
+            res.append(tmp)
+        return res
 
-def get_frame_info():
-    # 统一不同动态设置下的图像及其位置坐标
-    dir1 = './Town02/W000_P100_V000_P000'
-    dir2 = './Town02/W000_P100_V050_P200'
-    dir3 = './Town02/W000_P100_V075_P300'
-    static_list = os.listdir(os.path.join(dir1, 'RGB'))
-    dynamic1_list = os.listdir(os.path.join(dir2, 'RGB'))
-    dynamic2_list = os.listdir(os.path.join(dir3, 'RGB'))  # frame 最多
-
-    for frame in dynamic2_list:
-        if frame not in dynamic1_list or frame not in static_list:
-            for dir_ in [dir1, dir2, dir3]:
-                for parse in ['Depth', 'RGB', 'SemanticSegmentation']:
-                    try:
-                        os.remove(os.path.join(dir_, parse, frame))
-                    except:
-                        pass
-
-    frame_img = os.listdir(os.path.join(dir1, 'RGB'))
-    trajectory = np.loadtxt(os.path.join(dir3, 'Trajectory.txt'))
-    frame_pos = []
-    for path in frame_img:
-        frame_num = int(path[-10:-4])
-        frame_pos.append(trajectory[frame_num,[1,2]])
-    return frame_img, frame_pos
+
+def get_frame_info(town_dir='./Town02',
+                   conditions=('W000_P100_V000_P000', 'W000_P100_V050_P200', 'W000_P100_V075_P300')):
+    # 统一不同动态设置下的图像及其位置坐标：取各设置都有的帧（不删除任何文件），
+    # 清单按目录 mtime 缓存，目录未变时不再扫描
+    return FrameManifest.load(town_dir).frame_info(conditions)
 
 
 def get_topN_from_training(res, training_parse, topN=5):
@@ -129,35 +311,19 @@ def get_topN_from_training(res, training_parse, topN=5):
 
 if __name__ == '__main__':
 
-    frame_img, frame_pos = get_frame_info()
-
-    query_dir = 'D:\\MyFiles\\SceneTransformation\\Relocalization_all\\Town02\\W000_P100_V000_P000'
-    img_names = os.listdir(os.path.join(query_dir, 'RGB'))  # 训练样本文件夹路径
+    town_dir = 'D:\\MyFiles\\SceneTransformation\\Relocalization_all\\Town02'
+    reference, query = 'W000_P100_V000_P000', 'W000_P100_V000_P000'
+    manifest = FrameManifest.load(town_dir, verbose=True)
 
     ImgRetrieval = ImageRetrieval()
     # ImgRetrieval.gen_vocabulary(word_num=1000)
     ImgRetrieval.commit_database()
 
-error_rate_save = []
-for i in range(len(img_names)):
-    query_image_path = os.path.join(query_dir, 'RGB', img_names[i])
-    ind = frame_img.index(query_image_path[-10:])
-    query_image_pos = frame_pos[ind]
-    res, src = ImgRetrieval.image_query(query_image_path, nbr_results=3*len(img_names), src_return=True)
-    res_filter = get_topN_from_training(res, training_parse='W000_P100_V000_P000', topN=5)
-    # imagesearch.plot_results(src, [w[0]+1 for w in res_filter])  # 此处，数据库序号从1开始，故1
-
-    if len(res_filter):
-        pos = np.array([frame_pos[w[0]] for w in res_filter])
-        error_rate = np.abs((pos[0][0]-query_image_pos[0])/(query_image_pos[0]+1e-3)) + \
-                     np.abs((pos[0][1]-query_image_pos[1])/(query_image_pos[1]+1e-3))
-        error_rate_save.append(error_rate)
-    else:
-        print('no matched')
-        error_rate = 1
-        error_rate_save.append(error_rate)
-    # print(query_image_path, query_image_pos)
-    # print(res_filter)
-    # print(pos)
-print('mean_error', np.mean(error_rate_save))
+    # 只查询参考设置中也有的帧
+    query_image_paths = manifest.paths(query, manifest.common([reference, query]))
+    results = ImgRetrieval.image_query_batch(query_image_paths, k=5, restrict_to=reference)
 
+    # 按帧名查位置，多个阈值的误差/准确率与 recall@k 一次向量化计算
+    report = Evaluation.evaluate(Evaluation.FrameIndex.from_manifest(manifest, [reference]), query_image_paths,
+                                 results, thresholds=(0.01, 0.05), weight=1.0)
+    Evaluation.print_report(report)
@@ -0,0 +1,71 @@
+import os
+import sys
+import shutil
+import argparse
+
+
+FAKE_B = 'fake_B'
+
+
+def processed_name(item):
+    # '000030_fake_B.png' -> '000030.png'
+    return item[:6] + '.png'
+
+
+def _place(src, dest, mode):
+    if mode == 'move':
+        try:
+            os.replace(src, dest)  # 同一文件系统内只改目录项，不复制数据
+        except OSError:
+            shutil.move(src, dest)
+    else:
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)  # 不同文件系统或不支持硬链接
+
+
+def ingest(images_dir, dest_dir, mode='link'):
+    """ Put every fake_B output of the Dynamic2static model (its images
+        folder) into dest_dir as xxxxxx.png, by hardlink (mode='link') or
+        rename (mode='move'), in one pass. Yields each destination path
+        as soon as it is in place, so the caller can extract and index
+        while the rest is still being ingested. Outputs already ingested
+        are yielded without touching them. """
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    for item in sorted(os.listdir(images_dir)):
+        if FAKE_B not in item:
+            continue  # Gx, real_A, ...
+        src = os.path.join(images_dir, item)
+        dest = os.path.join(dest_dir, processed_name(item))
+        if os.path.exists(dest):
+            if os.path.samefile(src, dest) or os.path.getmtime(dest) >= os.path.getmtime(src):
+                yield dest
+                continue
+            os.remove(dest)  # 模型重新推理过，替换旧文件
+        _place(src, dest, mode)
+        yield dest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ingest the fake_B outputs of the Dynamic2static model')
+    parser.add_argument('--images', required=True, help='images folder of the model, e.g. W000_P100_V075_P300/images')
+    parser.add_argument('--dest', default=None, help='default: ProcessedImages next to the images folder')
+    parser.add_argument('--mode', default='link', choices=['link', 'move'])
+    parser.add_argument('--index', action='store_true', help='extract and index the images while they are ingested')
+    args = parser.parse_args(argv)
+
+    dest = args.dest or os.path.join(os.path.dirname(os.path.abspath(args.images)), 'ProcessedImages')
+    if args.index:
+        from ImageRetrieval import ImageRetrieval
+        ImageRetrieval().add_processed(args.images, dest, args.mode)
+    else:
+        nbr = 0
+        for path in ingest(args.images, dest, args.mode):
+            nbr += 1
+        print('ingested', nbr, 'images into', dest)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+import re
+import sys
+import heapq
+import logging
+import pickle
+import argparse
+import threading
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import Listener, Client
+from sqlite3 import dbapi2 as sqlite
+import numpy as np
+from BOW.imagesearch.vocabulary import extract_feature
+from BOW.imagesearch import imagesearch
+
+
+FOLDER_PATTERN = re.compile(r'W\d{3}_P\d{3}_V\d{3}_P\d{3}')
+
+
+def outside_folders(filename):
+    """ Shard predicate of the images not under any condition folder. """
+    return FOLDER_PATTERN.search(filename) is None
+
+
+def shard_by_folder(database_name):
+    # 按动态设置文件夹（如 W000_P100_V050_P200）划分分片，每个文件夹一个分片；
+    # 不在任何设置文件夹下的图像放入最后一个分片，而不是被漏掉
+    con = sqlite.connect(database_name)
+    try:
+        names = [r[0] for r in con.execute('select filename from imlist')]
+    finally:
+        con.close()
+    matches = [FOLDER_PATTERN.search(name) for name in names]
+    folders = sorted(set(m.group(0) for m in matches if m))
+    shards = [[folder] for folder in folders]
+    nbr_outside = sum(1 for m in matches if m is None)
+    if nbr_outside:
+        logging.warning('%d indexed images are not under a condition folder, they get a shard of their own',
+                        nbr_outside)
+        shards.append(outside_folders)
+    return shards
+
+
+def shard_worker(conn, database_name, vocabulary_path, shard):
+    """ Serve one shard of the index over a pipe until 'stop'. """
+    with open(vocabulary_path, 'rb') as f:
+        voc = pickle.load(f)
+    src = imagesearch.SparseSearcher(database_name, voc, shard=shard)
+    conn.send(('ready', len(src.filenames)))
+    while True:
+        request = conn.recv()
+        op = request[0]
+        if op == 'stop':
+            break
+        elif op == 'histograms':
+            # 本分片已入库图像的直方图（稀疏形式）
+            res = {}
+            for path in request[1]:
+                if path in src.row_of:
+                    row = src.histograms[src.row_of[path]]
+                    res[path] = (row.indices.copy(), row.data.copy())
+            conn.send(res)
+        elif op == 'query':
+            hists, k, restrict_to = request[1:]
+            res = src.query_batch(hists, k=k, restrict_to=restrict_to)
+            conn.send([[(d, imid, src.get_filename(imid)) for d, imid in items] for items in res])
+    conn.close()
+
+
+def merge_topk(lists, k):
+    """ k best (distance, imid, filename) of several sorted per-shard
+        lists; an image found by more than one shard (its filename
+        matches several shard parts) is kept once. """
+    res, seen = [], set()
+    for item in heapq.merge(*lists, key=lambda x: (x[0], x[1])):
+        if item[1] in seen:
+            continue
+        seen.add(item[1])
+        res.append(item)
+        if len(res) == k:
+            break
+    return res
+
+
+class RetrievalServer():
+    """ Retrieval service: the index is split into shards, each loaded by
+        its own worker process, and batched queries arrive over a local
+        socket (('localhost', port) for TCP or a file path for a Unix
+        socket). A request is fanned out to every shard and the per-shard
+        top-k lists are merged. """
+
+    def __init__(self, database_name, vocabulary_path, shards=None, address=('localhost', 6000),
+                 authkey=b'relocalization', feature='orb'):
+        self.database_name = database_name
+        self.vocabulary_path = vocabulary_path
+        self.shards = shard_by_folder(database_name) if shards is None else shards
+        self.address = address
+        self.authkey = authkey
+        self.feature = feature
+        with open(vocabulary_path, 'rb') as f:
+            self.voc = pickle.load(f)
+        self.workers = []
+        self.listener = None
+        self._thread = None
+
+    def start_shards(self):
+        for shard in self.shards:
+            conn, child = Pipe()
+            p = Process(target=shard_worker, args=(child, self.database_name, self.vocabulary_path, shard))
+            p.daemon = True
+            p.start()
+            status, nbr_images = conn.recv()
+            print('shard', getattr(shard, '__name__', shard), 'ready with', nbr_images, 'images')
+            self.workers.append((p, conn, threading.Lock()))
+
+    def _fanout(self, request):
+        # 同时发给所有分片，再依次收取结果（各分片并行计算）
+        for p, conn, lock in self.workers:
+            lock.acquire()
+        try:
+            for p, conn, lock in self.workers:
+                conn.send(request)
+            return [conn.recv() for p, conn, lock in self.workers]
+        finally:
+            for p, conn, lock in self.workers:
+                lock.release()
+
+    def histograms(self, paths):
+        """ Histograms for paths: from the shard holding the image, or
+            extracted and projected here for images not in the index. """
+        found = {}
+        for res in self._fanout(('histograms', paths)):
+            found.update(res)
+        hists = np.zeros((len(paths), self.voc.nbr_words))
+        for i, path in enumerate(paths):
+            if path in found:
+                words, counts = found[path]
+                hists[i, words] = counts
+            else:
+                hists[i] = self.voc.project(extract_feature(path, self.feature))
+        return hists
+
+    def query_batch(self, paths, k=5, restrict_to=None):
+        """ Merged top-k [(distance, imid, filename), ...] for every path. """
+        hists = self.histograms(paths)
+        per_shard = self._fanout(('query', hists, k, restrict_to))
+        return [merge_topk([res[i] for res in per_shard], k) for i in range(len(paths))]
+
+    def handle(self, conn):
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    if request['op'] == 'query':
+                        conn.send({'ok': True, 'results': self.query_batch(
+                            request['paths'], request.get('k', 5), request.get('restrict_to'))})
+                    elif request['op'] == 'shards':
+                        conn.send({'ok': True, 'results': self.shards})
+                    else:
+                        conn.send({'ok': False, 'error': 'unknown op %r' % request['op']})
+                except Exception as error:
+                    conn.send({'ok': False, 'error': repr(error)})
+        finally:
+            conn.close()
+
+    def _listen(self):
+        if not self.workers:
+            self.start_shards()
+        self.listener = Listener(self.address, authkey=self.authkey)
+        self.address = self.listener.address
+        print('retrieval server listening on', self.address)
+
+    def _accept_loop(self):
+        listener = self.listener
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:
+                break  # listener closed by stop()
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def serve_forever(self):
+        self._listen()
+        self._accept_loop()
+
+    def start(self):
+        """ Start shards and serve in a background thread (for local tests). """
+        self._listen()
+        self._thread = threading.Thread(target=self._accept_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.address
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.close()
+        for p, conn, lock in self.workers:
+            with lock:
+                conn.send(('stop',))
+            p.join()
+        self.workers = []
+
+
+class RetrievalClient():
+    def __init__(self, address=('localhost', 6000), authkey=b'relocalization'):
+        self.conn = Client(address, authkey=authkey)
+
+    def close(self):
+        self.conn.close()
+
+    def _call(self, request):
+        self.conn.send(request)
+        response = self.conn.recv()
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response['results']
+
+    def query_batch(self, paths, k=5, restrict_to=None):
+        return self._call({'op': 'query', 'paths': list(paths), 'k': k, 'restrict_to': restrict_to})
+
+    def image_query_batch(self, paths, k=5, restrict_to=None):
+        # 与 ImageRetrieval.image_query_batch 相同的 [index, path, score] 格式
+        return [[[imid - 1, filename, d] for d, imid, filename in items]
+                for items in self.query_batch(paths, k, restrict_to)]
+
+    def shards(self):
+        return self._call({'op': 'shards'})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='sharded retrieval server')
+    parser.add_argument('--db', default='ImaAdd.db')
+    parser.add_argument('--vocabulary', required=True)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6000)
+    parser.add_argument('--unix', default=None, help='serve on a Unix socket path instead of TCP')
+    parser.add_argument('--shard', action='append', default=None,
+                        help='comma separated folder names of one shard, repeat per shard (default: one per folder)')
+    args = parser.parse_args(argv)
+
+    shards = None if args.shard is None else [s.split(',') for s in args.shard]
+    address = args.unix if args.unix else (args.host, args.port)
+    server = RetrievalServer(args.db, args.vocabulary, shards, address)
+    try:
+        server.serve_forever()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+
+from BOW.imagesearch.descriptorcache import DescriptorCache
+from BOW.imagesearch.vocabulary import extract_feature
+
+
+def make_images(folder, n, seed=0):
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(n):
+        img = cv2.GaussianBlur(rng.integers(0, 256, (128, 128, 3), dtype=np.uint8), (5, 5), 0)
+        paths.append(os.path.join(str(folder), '%06d.png' % i))
+        cv2.imwrite(paths[-1], img)
+    return paths
+
+
+def assert_same(cache, paths):
+    for path, des in zip(paths, cache.get(paths, workers=1)):
+        assert np.array_equal(des, extract_feature(path, 'orb'))
+
+
+def test_stray_pool_without_index(tmp_path):
+    paths = make_images(tmp_path, 3)
+    cache = DescriptorCache(str(tmp_path / 'cache'))
+    # 首次追加中断：pool.u8 已写入，index.json 未保存
+    with open(cache.pool_path, 'wb') as f:
+        f.write(b'\x07' * 32 * 100)
+    assert_same(DescriptorCache(str(tmp_path / 'cache')), paths)
+
+
+def test_stray_rows_after_indexed_pool(tmp_path):
+    paths = make_images(tmp_path, 4)
+    cache = DescriptorCache(str(tmp_path / 'cache'))
+    cache.get(paths[:2], workers=1)
+    # 之后一次追加中断，留下不完整的行
+    with open(cache.pool_path, 'ab') as f:
+        f.write(b'\x07' * 45)
+    cache = DescriptorCache(str(tmp_path / 'cache'))
+    assert_same(cache, paths)
+    assert os.path.getsize(cache.pool_path) == cache._indexed_rows() * cache.width
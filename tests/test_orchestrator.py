@@ -0,0 +1,48 @@
+import os
+import sys
+import threading
+import pytest
+
+pytest.importorskip('carla')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'CARLA'))
+
+from carla.tcp import TCPConnectionError
+import DatasetOrchestrator as orchestrator
+
+
+class FlakyOrchestrator(orchestrator.Orchestrator):
+    """ Endpoints in dead refuse every connection, the others record an
+        empty episode. """
+
+    def __init__(self, out_dir, endpoints, dead, **kwargs):
+        orchestrator.Orchestrator.__init__(self, out_dir, endpoints, retry_delay=0.01, **kwargs)
+        self.dead = dead
+        self.ran_on = {}
+        self.ran_lock = threading.Lock()
+
+    def run_job(self, job, endpoint):
+        if endpoint in self.dead:
+            raise TCPConnectionError('%s:%s is down' % endpoint)
+        os.makedirs(self.final_dir(job))
+        open(os.path.join(self.final_dir(job), 'job.json'), 'w').close()
+        with self.ran_lock:
+            self.ran_on[job.name] = endpoint
+
+
+def test_retries_move_to_a_healthy_endpoint(tmp_path):
+    dead, healthy = ('localhost', 2000), ('localhost', 2002)
+    jobs = orchestrator.job_matrix([0, 1, 2], [100], [(50, 200)], queries=True)
+    o = FlakyOrchestrator(str(tmp_path), [dead, healthy], [dead])
+    status = o.run(jobs)
+    assert all(s['state'] == 'done' for s in status.values()), status
+    assert set(o.ran_on.values()) == {healthy}
+    assert o.unhealthy == [dead]
+
+
+def test_all_endpoints_down_fails_every_job(tmp_path):
+    endpoints = [('localhost', 2000), ('localhost', 2002)]
+    jobs = orchestrator.job_matrix([0, 1], [100], [(50, 200)], queries=True)
+    status = FlakyOrchestrator(str(tmp_path), endpoints, endpoints).run(jobs)
+    states = dict((name, s['state']) for name, s in status.items())
+    assert set(s for name, s in states.items() if status[name]['kind'] == 'reference') == {'failed'}
+    assert set(s for name, s in states.items() if status[name]['kind'] == 'query') == {'skipped'}